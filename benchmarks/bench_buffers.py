@@ -0,0 +1,145 @@
+""" Receive throughput of libserver.Message by message size.
+
+    Compares the current buffer handling (recv_into a
+    preallocated buffer) with the original bytes-concatenating
+    reader, for binary messages from 1 KB to 100 MB sent over
+    a local socket pair. Run from the repository root:
+
+        python -m benchmarks.bench_buffers
+"""
+
+###########
+# Imports #
+###########
+# Import system packages
+import argparse
+import selectors
+import socket
+import threading
+import time
+
+# Import custom modules
+from server import libserver
+from server import protocol
+
+
+#########
+# BEGIN #
+#########
+SIZES = [2**10, 2**14, 2**17, 2**20, 2**23, 100 * 2**20]
+
+
+class _BenchServer:
+    """ The parts of app_server.Server that Message uses.
+    """
+    keep_alive = False
+
+    def __init__(self, read_size):
+        self.read_size = read_size
+
+    def post_event(self, kind, **info):
+        pass
+
+    def reserve(self, nbytes):
+        # No buffer limits while benchmarking
+        return None
+
+    def release(self, nbytes):
+        pass
+
+
+def _message(size):
+    return protocol.create_message(
+        content_bytes=bytes(size),
+        content_type="binary/bench",
+        content_encoding="binary",
+    )
+
+
+def _send(sock, message):
+    sock.sendall(message)
+
+
+def receive_current(sock, read_size):
+    """ Receive one message with libserver.Message.
+    """
+    sel = selectors.DefaultSelector()
+    message = libserver.Message(
+        _BenchServer(read_size), sel, sock, None, None)
+    sel.register(sock, selectors.EVENT_READ, data=message)
+    while message.request is None:
+        sel.select()
+        message.read()
+    sel.close()
+    return len(message.request)
+
+
+def receive_original(sock, read_size):
+    """ Receive one message the way libserver.Message did
+        originally: bytes concatenation and re-slicing.
+    """
+    sel = selectors.DefaultSelector()
+    sel.register(sock, selectors.EVENT_READ)
+    buffer = b""
+    jsonheader_len = None
+    jsonheader = None
+    while True:
+        sel.select()
+        buffer += sock.recv(read_size)
+        if jsonheader_len is None and len(buffer) >= 2:
+            jsonheader_len = protocol.unpack_protoheader(buffer[:2])
+            buffer = buffer[2:]
+        if jsonheader_len is not None and jsonheader is None:
+            if len(buffer) >= jsonheader_len:
+                jsonheader = protocol.parse_jsonheader(
+                    buffer[:jsonheader_len])
+                buffer = buffer[jsonheader_len:]
+        if jsonheader is not None:
+            content_len = jsonheader["content-length"]
+            if len(buffer) >= content_len:
+                sel.close()
+                return len(buffer[:content_len])
+
+
+def measure(receiver, size, read_size, repeat):
+    message = _message(size)
+    best = float('inf')
+    for _ in range(repeat):
+        rsock, wsock = socket.socketpair()
+        rsock.setblocking(False)
+        sender = threading.Thread(target=_send, args=(wsock, message))
+        start = time.perf_counter()
+        sender.start()
+        received = receiver(rsock, read_size)
+        elapsed = time.perf_counter() - start
+        sender.join()
+        rsock.close()
+        wsock.close()
+        assert received == size
+        best = min(best, elapsed)
+    return size / best / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--read-size', type=int, default=libserver.READ_SIZE,
+        help="bytes per recv for the current reader")
+    parser.add_argument('--original-read-size', type=int, default=4096,
+        help="bytes per recv for the original reader")
+    parser.add_argument('--original-max', type=int, default=2**23,
+        help="skip the original reader above this size (it is quadratic)")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"\n{'size':>12} {'original MB/s':>14} {'current MB/s':>13}")
+    for size in SIZES:
+        if size <= args.original_max:
+            original = f"{measure(receive_original, size, args.original_read_size, args.repeat):>14.1f}"
+        else:
+            original = f"{'skipped':>14}"
+        current = measure(receive_current, size, args.read_size, args.repeat)
+        print(f"{size:>12} {original} {current:>13.1f}")
+
+
+if __name__ == '__main__':
+    main()
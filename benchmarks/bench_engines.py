@@ -0,0 +1,127 @@
+""" Compare per-request latency of the server engines.
+
+    Starts each engine in-process, then runs several clients
+    at once, each sending requests over a keep-alive
+    connection. Run from the repository root:
+
+        python -m benchmarks.bench_engines --clients 1 8 32
+"""
+
+###########
+# Imports #
+###########
+# Import system packages
+import argparse
+import socket
+import statistics
+import threading
+import time
+
+# Import custom modules
+from server import app_server
+from server import async_server
+from server import protocol
+
+
+#########
+# BEGIN #
+#########
+ENGINES = {
+    'selectors': app_server.Server,
+    'asyncio': async_server.AsyncServer,
+}
+
+
+def recv_message(sock, buffer):
+    """ Read one framed message. Returns (jsonheader, content,
+        leftover bytes).
+    """
+    def fill(n):
+        nonlocal buffer
+        while len(buffer) < n:
+            data = sock.recv(65536)
+            if not data:
+                raise RuntimeError("bench: Server closed connection")
+            buffer += data
+
+    fill(protocol.PROTOHEADER_LEN)
+    hdrlen = protocol.unpack_protoheader(buffer)
+    fill(protocol.PROTOHEADER_LEN + hdrlen)
+    jsonheader = protocol.parse_jsonheader(
+        buffer[protocol.PROTOHEADER_LEN:protocol.PROTOHEADER_LEN + hdrlen])
+    buffer = buffer[protocol.PROTOHEADER_LEN + hdrlen:]
+    fill(jsonheader["content-length"])
+    content = buffer[:jsonheader["content-length"]]
+    return jsonheader, content, buffer[jsonheader["content-length"]:]
+
+
+def client(host, port, requests, latencies, action):
+    request = protocol.create_message(
+        **protocol.json_response({"action": action}), keep_alive=True)
+    with socket.create_connection((host, port)) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        buffer = b""
+        for _ in range(requests):
+            start = time.perf_counter()
+            sock.sendall(request)
+            _, _, buffer = recv_message(sock, buffer)
+            latencies.append(time.perf_counter() - start)
+
+
+def run(engine, port, clients, requests, action):
+    server = ENGINES[engine](audio_device=None, port=port)
+    server.start()
+    time.sleep(0.5)
+    try:
+        latencies = []
+        threads = [
+            threading.Thread(target=client, args=(
+                server.host, port, requests, latencies, action))
+            for _ in range(clients)
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        server.stop()
+        server.thread.join()
+
+    latencies.sort()
+    return {
+        'engine': engine,
+        'clients': clients,
+        'requests': len(latencies),
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000,
+        'req_per_s': len(latencies) / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=200,
+        help="requests per client")
+    parser.add_argument('--action', default='stopaudio')
+    parser.add_argument('--port', type=int, default=65433)
+    args = parser.parse_args()
+
+    results = []
+    for engine in ENGINES:
+        for clients in args.clients:
+            results.append(
+                run(engine, args.port, clients, args.requests, args.action))
+
+    print(f"\n{'engine':>10} {'clients':>8} {'mean ms':>9} "
+        f"{'p50 ms':>8} {'p99 ms':>8} {'req/s':>9}")
+    for r in results:
+        print(f"{r['engine']:>10} {r['clients']:>8} {r['mean_ms']:>9.3f} "
+            f"{r['p50_ms']:>8.3f} {r['p99_ms']:>8.3f} {r['req_per_s']:>9.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+""" Peak memory of loading and playing a file, by file size.
+
+    For stereo 16-bit WAV files of several durations, measures
+    the peak memory allocated (tracemalloc) while an Audio
+    object is created and while play() prepares the stimulus,
+    next to the original pipeline (float64 decode, copy,
+    float32 conversion, level, clip check). Playback uses the
+    stand-in backend (benchmarks/null_audio.py). Run from the
+    repository root:
+
+        python -m benchmarks.bench_memory --durations 1 10 60 300
+"""
+
+###########
+# Imports #
+###########
+# Import data science packages
+import numpy as np
+import soundfile as sf
+
+# Import system packages
+import argparse
+import os
+import tempfile
+import tracemalloc
+
+# Import custom modules
+from benchmarks import null_audio
+from models import audiocache
+from models import audiomodel
+from models import playback
+
+
+#########
+# BEGIN #
+#########
+DURATIONS = [1, 10, 60, 300]
+
+SAMPLERATE = 48000
+
+LEVEL = -20
+
+
+def make_stimulus(directory, duration):
+    t = np.arange(int(duration * SAMPLERATE)) / SAMPLERATE
+    tone = (0.1 * np.sin(2 * np.pi * 1000 * t)).astype(np.float32)
+    path = os.path.join(directory, f"tone_{duration:g}s.wav")
+    sf.write(path, np.column_stack([tone, tone]), SAMPLERATE,
+        subtype='PCM_16')
+    return path
+
+
+def peak(func, *args):
+    """ Run func and return (result, peak bytes allocated).
+    """
+    tracemalloc.start()
+    try:
+        result = func(*args)
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def original_pipeline(path):
+    """ Load and level a file the way Audio did before.
+    """
+    signal, fs = sf.read(path)
+    temp = signal.copy()
+    temp = temp.astype(np.float32)
+    temp = temp * audiomodel.Audio.db2mag(LEVEL)
+    np.max(np.abs(temp))
+    return temp
+
+
+def measure(path):
+    original = peak(original_pipeline, path)[1]
+
+    audiocache.cache.evict()
+    audio, load = peak(audiomodel.Audio, path, False)
+    _, play = peak(audio.play, LEVEL, 0)
+    audio.stop()
+    if audio.mapped is not None:
+        mode = 'mapped'
+    elif audio.streamed:
+        mode = 'streamed'
+    else:
+        mode = 'decoded'
+    return {
+        'bytes': os.path.getsize(path),
+        'mode': mode,
+        'load': load,
+        'play': play,
+        'original': original,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--durations', type=float, nargs='+',
+        default=DURATIONS, help="stimulus durations (seconds)")
+    args = parser.parse_args()
+
+    null_audio.install()
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for duration in args.durations:
+            results.append(measure(make_stimulus(directory, duration)))
+    playback.close_streams()
+
+    mb = 2**20
+    print(f"\n{'file MB':>9} {'mode':>9} {'load MB':>9} {'play MB':>9} "
+        f"{'total MB':>9} {'original':>9}")
+    for r in results:
+        print(f"{r['bytes'] / mb:>9.1f} {r['mode']:>9} {r['load'] / mb:>9.1f} "
+            f"{r['play'] / mb:>9.1f} {(r['load'] + r['play']) / mb:>9.1f} "
+            f"{r['original'] / mb:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
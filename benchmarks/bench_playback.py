@@ -0,0 +1,126 @@
+""" Command-to-first-sample latency of the two playback modes.
+
+    Starts a short stimulus many times, once with a stream
+    opened for every stimulus and once through the device's
+    persistent stream (models.playback), and reports how long
+    each took from the play command to the callback that
+    rendered its first sample. Adding the stream's reported
+    output latency gives an estimate of when that sample
+    reached the DAC. Run from the repository root:
+
+        python -m benchmarks.bench_playback --blocksize 256
+
+    By default the stand-in backend (benchmarks/null_audio.py)
+    is used. It opens streams instantly, so it only shows the
+    software path and the wait for the next block. Pass
+    --device to measure a real device, where opening a stream
+    takes time (most of all on ASIO).
+"""
+
+###########
+# Imports #
+###########
+# Import system packages
+import argparse
+import random
+import statistics
+import time
+
+# Import custom modules
+from benchmarks import null_audio
+from models import playback
+
+
+#########
+# BEGIN #
+#########
+SAMPLERATE = 48000
+CHANNELS = 2
+
+# Stimulus length (seconds)
+DURATION = 0.02
+
+
+class ProbeSource:
+    """ Low-level tone that notes when its first block is
+        requested.
+    """
+
+    def __init__(self, frames, channels):
+        self.channels = channels
+        self.remaining = frames
+        self.first = None
+
+
+    def read_into(self, outdata):
+        if self.first is None:
+            self.first = time.perf_counter()
+        frames = min(len(outdata), self.remaining)
+        outdata[:frames] = 0.01
+        self.remaining -= frames
+        return frames
+
+
+def measure(device, persistent, trials):
+    """ Play the probe `trials` times. Returns (command to first
+        callback, reported output latency) pairs in seconds.
+    """
+    frames = int(DURATION * SAMPLERATE)
+    results = []
+    for _ in range(trials):
+        source = ProbeSource(frames, CHANNELS)
+        start = time.perf_counter()
+        player = playback.StreamPlayer(source, SAMPLERATE, CHANNELS,
+            device=device, persistent=persistent)
+        player.start()
+        player.finished.wait()
+        results.append((source.first - start, player.stream.latency))
+        # Spread command times over the block period
+        time.sleep(random.uniform(0.01, 0.03))
+    return results
+
+
+def summarize(name, results):
+    callback = sorted(first for first, _ in results)
+    dac = sorted(first + out for first, out in results)
+    def ms(values, q):
+        return values[min(len(values) - 1, int(len(values) * q))] * 1000
+    print(f"{name:>12} {statistics.median(callback) * 1000:>10.2f} "
+        f"{ms(callback, 0.9):>10.2f} {callback[-1] * 1000:>10.2f} "
+        f"{statistics.median(dac) * 1000:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--device', type=int,
+        help="audio device ID; omit to use the stand-in backend")
+    parser.add_argument('--trials', type=int, default=50)
+    parser.add_argument('--blocksize', type=int, default=512)
+    parser.add_argument('--latency', default='low',
+        help="suggested output latency: seconds, 'low' or 'high'")
+    args = parser.parse_args()
+
+    if args.device is None:
+        null_audio.install()
+    try:
+        output_latency = float(args.latency)
+    except ValueError:
+        output_latency = args.latency
+    playback.configure(blocksize=args.blocksize, latency=output_latency,
+        preroll=0.0)
+
+    print(f"bench: blocksize {args.blocksize}, latency {args.latency}, "
+        f"{args.trials} trials")
+    print(f"\n{'mode':>12} {'p50 ms':>10} {'p90 ms':>10} {'max ms':>10} "
+        f"{'p50 DAC ms':>10}")
+    summarize('per-play', measure(args.device, False, args.trials))
+
+    # Open the persistent stream before timing
+    measure(args.device, True, 1)
+    summarize('persistent', measure(args.device, True, args.trials))
+    playback.close_streams()
+
+
+if __name__ == '__main__':
+    main()
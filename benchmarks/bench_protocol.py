@@ -0,0 +1,84 @@
+""" Encode/decode cost per message for protocol v1 and v2.
+
+    Times framing a request, parsing it back the way the server
+    does, and doing the same for the response. No sockets are
+    involved. Run from the repository root:
+
+        python -m benchmarks.bench_protocol
+"""
+
+###########
+# Imports #
+###########
+# Import system packages
+import argparse
+import timeit
+
+# Import custom modules
+from server import protocol
+
+
+#########
+# BEGIN #
+#########
+REQUESTS = {
+    'playaudio': {
+        "action": "playaudio",
+        "value": {
+            "filepath": "C:\\Stimuli\\IEEE\\list01_s01.wav",
+            "level": -25.0,
+        },
+    },
+    'stopaudio': {"action": "stopaudio"},
+}
+
+RESPONSE = {"result": "Stopping audio playback"}
+
+
+def round_trip_v1(request):
+    # Client encodes the request
+    message = protocol.create_message(
+        **protocol.json_response(request), keep_alive=True)
+    # Server decodes it
+    hdrlen = protocol.unpack_protoheader(message)
+    start = protocol.PROTOHEADER_LEN
+    jsonheader = protocol.parse_jsonheader(message[start:start + hdrlen])
+    body = message[start + hdrlen:]
+    protocol.decode_content(jsonheader, body)
+    # Server encodes the response; client decodes it
+    message = protocol.create_message(
+        **protocol.json_response(RESPONSE), keep_alive=True)
+    hdrlen = protocol.unpack_protoheader(message)
+    jsonheader = protocol.parse_jsonheader(message[start:start + hdrlen])
+    protocol.decode_content(
+        jsonheader, message[start + hdrlen:], response=True)
+
+
+def round_trip_v2(request):
+    size = protocol.V2_HEADER.size
+    message = protocol.create_message_v2(**protocol.compact_request(request))
+    jsonheader = protocol.v2_jsonheader(message)
+    protocol.decode_content(jsonheader, message[size:])
+    message = protocol.create_message_v2(**protocol.compact_response(RESPONSE))
+    jsonheader = protocol.v2_jsonheader(message)
+    protocol.decode_content(jsonheader, message[size:], response=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"\n{'action':>10} {'v1 us/msg':>10} {'v2 us/msg':>10} {'speedup':>8}")
+    for name, request in REQUESTS.items():
+        times = []
+        for func in (round_trip_v1, round_trip_v2):
+            best = min(timeit.repeat(
+                lambda: func(request), number=args.number, repeat=5))
+            times.append(best / args.number * 1e6)
+        print(f"{name:>10} {times[0]:>10.2f} {times[1]:>10.2f} "
+            f"{times[0] / times[1]:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
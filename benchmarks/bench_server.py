@@ -0,0 +1,252 @@
+""" End-to-end server benchmark suite.
+
+    Runs each server engine in-process against the stand-in
+    audio backend (benchmarks/null_audio.py) and drives it with
+    the reference client (server/libclient.py). For every
+    action, payload size and number of concurrent clients it
+    measures round-trip latency and requests per second, then
+    writes the results as JSON. Run from the repository root:
+
+        python -m benchmarks.bench_server --output results.json
+
+    Compare against an earlier run to catch regressions:
+
+        python -m benchmarks.bench_server --baseline results.json
+"""
+
+###########
+# Imports #
+###########
+# Import data science packages
+import numpy as np
+import soundfile as sf
+
+# Import system packages
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Import custom modules
+from benchmarks import null_audio
+from benchmarks.bench_engines import ENGINES
+from server import libclient
+
+
+#########
+# BEGIN #
+#########
+# Stimulus durations (seconds) for playaudio
+DURATIONS = [0.5, 5.0, 30.0]
+
+# Body sizes (bytes) for binary requests
+BINARY_SIZES = [2**10, 2**16, 2**20]
+
+# Actions without a payload
+SIMPLE_ACTIONS = ['stopaudio', 'jobstatus', 'stats']
+
+SAMPLERATE = 48000
+
+# Results must match on these fields to be compared
+KEY_FIELDS = ('engine', 'action', 'payload_bytes', 'clients')
+
+
+def make_stimuli(directory, durations):
+    """ Write a stereo tone of each duration. Returns a list of
+        (path, file size) pairs.
+    """
+    stimuli = []
+    for duration in durations:
+        t = np.arange(int(duration * SAMPLERATE)) / SAMPLERATE
+        tone = 0.1 * np.sin(2 * np.pi * 1000 * t)
+        path = os.path.join(directory, f"tone_{duration:g}s.wav")
+        sf.write(path, np.column_stack([tone, tone]), SAMPLERATE,
+            subtype='PCM_16')
+        stimuli.append((path, os.path.getsize(path)))
+    return stimuli
+
+
+def cases(stimuli):
+    """ Yield (action, payload bytes, send function) for every
+        request type in the suite.
+    """
+    for action in SIMPLE_ACTIONS:
+        yield action, 0, lambda client, a=action: client.request(a)
+    for path, size in stimuli:
+        value = {"filepath": path, "level": -20}
+        yield 'playaudio', size, \
+            lambda client, v=value: client.request('playaudio', v)
+    for size in BINARY_SIZES:
+        body = bytes(size)
+        yield 'binary', size, lambda client, b=body: client.send_binary(b)
+
+
+def client_worker(server, send, requests, latencies, errors):
+    with libclient.Client(server.host, server.port) as client:
+        for _ in range(requests):
+            start = time.perf_counter()
+            try:
+                content = send(client)
+            except (OSError, ValueError):
+                errors.append(1)
+                continue
+            latencies.append(time.perf_counter() - start)
+            if isinstance(content, dict) and content.get("error"):
+                errors.append(1)
+
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def run_case(server, engine, action, payload_bytes, send, clients,
+    requests):
+    latencies = []
+    errors = []
+    threads = [
+        threading.Thread(target=client_worker,
+            args=(server, send, requests, latencies, errors))
+        for _ in range(clients)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    result = {
+        'engine': engine,
+        'action': action,
+        'payload_bytes': payload_bytes,
+        'clients': clients,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'req_per_s': round(len(latencies) / elapsed, 1),
+    }
+    if latencies:
+        ordered = sorted(latencies)
+        result.update({
+            'mean_ms': round(sum(ordered) / len(ordered) * 1000, 3),
+            'p50_ms': round(percentile(ordered, 50) * 1000, 3),
+            'p90_ms': round(percentile(ordered, 90) * 1000, 3),
+            'p99_ms': round(percentile(ordered, 99) * 1000, 3),
+            'max_ms': round(ordered[-1] * 1000, 3),
+        })
+    return result
+
+
+def run_engine(engine, port, stimuli, client_counts, requests):
+    # Closed connections may not be reaped before the next case
+    # connects, so leave room above the connection limit
+    server = ENGINES[engine](audio_device=0, port=port,
+        max_connections=4 * max(client_counts))
+    server.start()
+    time.sleep(0.5)
+    results = []
+    try:
+        for action, payload_bytes, send in cases(stimuli):
+            for clients in client_counts:
+                results.append(run_case(server, engine, action,
+                    payload_bytes, send, clients, requests))
+    finally:
+        with libclient.Client(server.host, server.port) as client:
+            client.request('stopaudio')
+        server.stop()
+        server.thread.join()
+    return results
+
+
+def metadata():
+    try:
+        revision = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'revision': revision,
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'backend': 'null_audio',
+    }
+
+
+def compare(results, baseline, tolerance):
+    """ Print cases whose median latency grew by more than
+        tolerance (a fraction) over the baseline. Returns the
+        number of regressions.
+    """
+    previous = {
+        tuple(r[f] for f in KEY_FIELDS): r for r in baseline['results']
+    }
+    regressions = 0
+    for result in results:
+        old = previous.get(tuple(result[f] for f in KEY_FIELDS))
+        if old is None or 'p50_ms' not in old or 'p50_ms' not in result:
+            continue
+        ratio = result['p50_ms'] / old['p50_ms'] if old['p50_ms'] else 1.0
+        if ratio > 1 + tolerance:
+            regressions += 1
+            print(f"bench: Regression: {result['engine']} "
+                f"{result['action']} ({result['payload_bytes']} bytes, "
+                f"{result['clients']} clients): p50 "
+                f"{old['p50_ms']:.3f} -> {result['p50_ms']:.3f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--engines', nargs='+', default=list(ENGINES),
+        choices=list(ENGINES))
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=50,
+        help="requests per client for each case")
+    parser.add_argument('--durations', type=float, nargs='+',
+        default=DURATIONS, help="playaudio stimulus durations (seconds)")
+    parser.add_argument('--port', type=int, default=65435)
+    parser.add_argument('--output', help="write results to this JSON file")
+    parser.add_argument('--baseline',
+        help="compare against results from an earlier run")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+        help="allowed growth in median latency (fraction)")
+    args = parser.parse_args()
+
+    null_audio.install()
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        stimuli = make_stimuli(directory, args.durations)
+        for engine in args.engines:
+            results.extend(run_engine(
+                engine, args.port, stimuli, args.clients, args.requests))
+
+    print(f"\n{'engine':>10} {'action':>10} {'bytes':>9} {'clients':>8} "
+        f"{'p50 ms':>8} {'p99 ms':>8} {'req/s':>9} {'errors':>7}")
+    for r in results:
+        print(f"{r['engine']:>10} {r['action']:>10} {r['payload_bytes']:>9} "
+            f"{r['clients']:>8} {r.get('p50_ms', 0):>8.3f} "
+            f"{r.get('p99_ms', 0):>8.3f} {r['req_per_s']:>9.0f} "
+            f"{r['errors']:>7}")
+
+    report = {'meta': metadata(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nbench: Wrote {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+""" Compare TCP loopback with the local (AF_UNIX) transport.
+
+    Measures round-trip latency for each server engine, both
+    over one keep-alive connection and with a new connection
+    per request (the original Vulcan pattern). Run from the
+    repository root (Linux/macOS only):
+
+        python -m benchmarks.bench_transport
+"""
+
+###########
+# Imports #
+###########
+# Import system packages
+import argparse
+import os
+import socket
+import tempfile
+import time
+
+# Import custom modules
+from benchmarks.bench_engines import ENGINES, recv_message
+from server import protocol
+
+
+#########
+# BEGIN #
+#########
+def connect(transport, server):
+    if transport == 'unix':
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(server.unix_path)
+    else:
+        sock = socket.create_connection((server.host, server.port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def keep_alive_latencies(transport, server, requests, action):
+    request = protocol.create_message(
+        **protocol.json_response({"action": action}), keep_alive=True)
+    latencies = []
+    with connect(transport, server) as sock:
+        buffer = b""
+        for _ in range(requests):
+            start = time.perf_counter()
+            sock.sendall(request)
+            _, _, buffer = recv_message(sock, buffer)
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def connect_per_request_latencies(transport, server, requests, action):
+    request = protocol.create_message(
+        **protocol.json_response({"action": action}))
+    latencies = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        with connect(transport, server) as sock:
+            sock.sendall(request)
+            recv_message(sock, b"")
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def summary(latencies):
+    latencies = sorted(latencies)
+    return (
+        latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.99)] * 1000,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--action', default='stopaudio')
+    parser.add_argument('--port', type=int, default=65434)
+    args = parser.parse_args()
+
+    unix_path = os.path.join(tempfile.mkdtemp(), 'vesta_audio.sock')
+    rows = []
+    for engine, server_class in ENGINES.items():
+        server = server_class(
+            audio_device=None, port=args.port, unix_path=unix_path)
+        server.start()
+        time.sleep(0.5)
+        try:
+            for transport in ('tcp', 'unix'):
+                for mode, func in (
+                    ('keep-alive', keep_alive_latencies),
+                    ('per-request', connect_per_request_latencies),
+                ):
+                    latencies = func(
+                        transport, server, args.requests, args.action)
+                    rows.append((engine, transport, mode) + summary(latencies))
+        finally:
+            server.stop()
+            server.thread.join()
+
+    print(f"\n{'engine':>10} {'transport':>10} {'connection':>12} "
+        f"{'p50 ms':>8} {'p99 ms':>8}")
+    for engine, transport, mode, p50, p99 in rows:
+        print(f"{engine:>10} {transport:>10} {mode:>12} "
+            f"{p50:>8.3f} {p99:>8.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+""" Stand-in audio backend for the benchmarks.
+
+    install() replaces sounddevice's OutputStream and
+    query_devices with versions that need no audio hardware.
+    NullOutputStream calls the stream callback from a thread at
+    the real sample rate and discards the audio, so playback
+    runs through the same code paths as on a device.
+"""
+
+###########
+# Imports #
+###########
+# Import data science packages
+import numpy as np
+
+# Import system packages
+import threading
+import time
+
+# Import audio packages
+import sounddevice as sd
+
+
+#########
+# BEGIN #
+#########
+DEVICE = {
+    'name': 'Null output',
+    'max_output_channels': 8,
+    'default_samplerate': 48000.0,
+    'default_low_output_latency': 0.005,
+    'default_high_output_latency': 0.02,
+}
+
+# Frames per callback when the caller does not choose
+BLOCKSIZE = 512
+
+
+class _Status:
+    output_underflow = False
+
+
+class _Time:
+    def __init__(self, now, latency):
+        self.currentTime = now
+        self.outputBufferDacTime = now + latency
+
+
+class NullOutputStream:
+    """ Drop-in for sd.OutputStream that discards the audio.
+    """
+
+    def __init__(self, samplerate=None, blocksize=None, device=None,
+        channels=None, dtype='float32', latency=None, callback=None,
+        finished_callback=None, **kwargs):
+        self.samplerate = samplerate or DEVICE['default_samplerate']
+        self.blocksize = blocksize or BLOCKSIZE
+        self.channels = channels or 1
+        self.dtype = dtype
+        self.device = device
+        if latency in (None, 'low'):
+            latency = DEVICE['default_low_output_latency']
+        elif latency == 'high':
+            latency = DEVICE['default_high_output_latency']
+        self.latency = latency
+        self.callback = callback
+        self.finished_callback = finished_callback
+        self.active = False
+        self.closed = False
+        self._thread = None
+
+
+    @property
+    def time(self):
+        return time.monotonic()
+
+
+    def start(self):
+        self.active = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+
+    def _run(self):
+        outdata = np.zeros((self.blocksize, self.channels), dtype=self.dtype)
+        period = self.blocksize / self.samplerate
+        deadline = time.monotonic()
+        while self.active:
+            try:
+                self.callback(outdata, self.blocksize,
+                    _Time(time.monotonic(), self.latency), _Status())
+            except sd.CallbackStop:
+                break
+            except sd.CallbackAbort:
+                break
+            deadline += period
+            time.sleep(max(0.0, deadline - time.monotonic()))
+        self.active = False
+        if self.finished_callback:
+            self.finished_callback()
+
+
+    def stop(self, ignore_errors=True):
+        self.active = False
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+
+    abort = stop
+
+
+    def close(self, ignore_errors=True):
+        self.stop()
+        self.closed = True
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def query_devices(device=None, kind=None):
+    if device is None and kind is None:
+        return [dict(DEVICE)]
+    return dict(DEVICE)
+
+
+def install():
+    """ Route all playback through the stand-in backend.
+    """
+    sd.OutputStream = NullOutputStream
+    sd.query_devices = query_devices
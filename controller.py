@@ -14,10 +14,13 @@
 ###########
 # Import GUI packages
 import tkinter as tk
+from tkinter import messagebox
 
 # Import system packages
 import os
 import sys
+import queue
+import multiprocessing
 
 # Import misc packages
 import webbrowser
@@ -29,17 +32,29 @@ from menus import mainmenu
 # Model imports
 from models import sessionmodel
 from models import audiomodel
+from models import playback
 # View imports
 from views import mainview
 from views import audioview
 from views import calibrationview
 # Server imports
 from server import app_server
+from server import async_server
 
 
 #########
 # BEGIN #
 #########
+# How often to check the server event queue (ms)
+SERVER_POLL_MS = 50
+
+# Available server engines
+SERVER_ENGINES = {
+    'selectors': app_server.Server,
+    'asyncio': async_server.AsyncServer,
+}
+
+
 class Application(tk.Tk):
     """ Application root window
     """
@@ -59,6 +74,11 @@ class Application(tk.Tk):
         self.sessionpars_model = sessionmodel.SessionParsModel()
         self._load_sessionpars()
 
+        # Server is created on demand
+        self.server = None
+        # True while _poll_server_events() is scheduled
+        self._polling = False
+
         # Load main view
         self.main_frame = mainview.MainFrame(self)
         self.main_frame.grid(row=5, column=5)
@@ -74,6 +94,9 @@ class Application(tk.Tk):
 
             # Server menu
             '<<ServerStartServer>>': lambda _: self.start_server(),
+            '<<ServerStopServer>>': lambda _: self.stop_server(),
+            '<<ServerRestartServer>>': lambda _: self.restart_server(),
+            '<<ServerEngine>>': lambda _: self._save_sessionpars(),
 
             # Tools menu
             '<<ToolsAudioSettings>>': lambda _: self._show_audio_dialog(),
@@ -87,7 +110,7 @@ class Application(tk.Tk):
             '<<CalStop>>': lambda _: self.stop_calibration_file(),
 
             # Audio dialog commands
-            '<<AudioDialogSubmit>>': lambda _: self._save_sessionpars(),
+            '<<AudioDialogSubmit>>': lambda _: self._on_audio_settings(),
         }
 
         # Bind callbacks to sequences
@@ -117,6 +140,13 @@ class Application(tk.Tk):
     def _quit(self):
         """ Exit the application.
         """
+        # Stop server thread
+        if self.server is not None:
+            self.server.stop()
+
+        # Release the audio devices
+        playback.close_streams()
+
         # Quit app
         self.destroy()
 
@@ -168,10 +198,134 @@ class Application(tk.Tk):
     # Server Menu Functions #
     #########################
     def start_server(self):
-        """ Create server and begin listening.
+        """ Create server and begin listening on a background
+            thread.
+        """
+        if self.server is not None and self.server.is_running():
+            print("\ncontroller: Server is already running")
+            return
+
+        engine = self.sessionpars["Server Engine"].get()
+        try:
+            server_class = SERVER_ENGINES[engine]
+        except KeyError:
+            print(f"\ncontroller: Unknown server engine '{engine}', "
+                "using selectors")
+            server_class = app_server.Server
+
+        if type(self.server) is server_class:
+            # Same engine: reuse the server to keep loaded audio
+            self.restart_server()
+            return
+
+        self.server = server_class(
+            audio_device=self.sessionpars["Audio Device ID"].get(),
+            unix_path=self.sessionpars["Local Socket Path"].get(),
+            devices=self._named_devices()
+            )
+        self.server.start()
+        self._start_polling()
+
+
+    def restart_server(self):
+        """ Restart the server in place with the current audio
+            device and socket settings.
         """
-        self.server = app_server.Server(
-            audio_device=self.sessionpars["Audio Device ID"].get()
+        if self.server is None:
+            self.start_server()
+            return
+        try:
+            self.server.restart(
+                audio_device=self.sessionpars["Audio Device ID"].get(),
+                unix_path=self.sessionpars["Local Socket Path"].get(),
+                devices=self._named_devices()
+            )
+        except RuntimeError as e:
+            messagebox.showerror(
+                title="Server Error",
+                message="Could not restart the server.",
+                detail=str(e)
+            )
+            return
+        self._start_polling()
+
+
+    def stop_server(self):
+        """ Stop the running server.
+        """
+        if self.server is None or not self.server.is_running():
+            print("\ncontroller: Server is not running")
+            return
+        self.server.stop()
+
+
+    def _named_devices(self):
+        """ Named devices from the audio settings. Invalid entries
+            are reported and ignored.
+        """
+        try:
+            return app_server.parse_devices(
+                self.sessionpars["Named Devices"].get())
+        except ValueError as e:
+            messagebox.showerror(
+                title="Audio Settings",
+                message="Named devices must look like 'phones=5, array=3'.",
+                detail=str(e)
+            )
+            return {}
+
+
+    def _start_polling(self):
+        if not self._polling:
+            self._polling = True
+            self._poll_server_events()
+
+
+    def _poll_server_events(self):
+        """ Pass queued server events to the GUI. Runs on the Tk
+            thread via after() for as long as the server is alive.
+        """
+        while True:
+            try:
+                kind, info = self.server.events.get_nowait()
+            except queue.Empty:
+                break
+            self._on_server_event(kind, info)
+
+        # Keep polling until the final events have been handled
+        if self.server.is_running() or not self.server.events.empty():
+            self.after(SERVER_POLL_MS, self._poll_server_events)
+        else:
+            self._polling = False
+
+
+    def _on_server_event(self, kind, info):
+        """ Update the main window for a single server event.
+        """
+        if kind == 'listening':
+            status = f"Listening on {info['host']}:{info['port']}"
+            if info.get('unix_path'):
+                status += f" and {info['unix_path']}"
+            self.main_frame.set_status(status)
+        elif kind == 'request':
+            self.main_frame.set_status(f"Received '{info['action']}'")
+        elif kind == 'playback_started':
+            self.main_frame.set_status(
+                f"Playing {os.path.basename(str(info['filepath']))}")
+        elif kind == 'playback_stopped':
+            self.main_frame.set_status("Playback ended")
+        elif kind == 'stopped':
+            self.main_frame.set_status("Server stopped")
+        elif kind == 'connection_error':
+            # Clients that misbehave or hang up are not worth a
+            # dialog each
+            self.main_frame.set_status(
+                f"Connection error from {info['addr']}: {info['message']}")
+        elif kind == 'error':
+            self.main_frame.set_status("Server error")
+            messagebox.showerror(
+                title="Server Error",
+                message=info['message']
             )
 
 
@@ -184,6 +338,18 @@ class Application(tk.Tk):
         print("\ncontroller: Calling audio dialog...")
         audioview.AudioDialog(self, self.sessionpars)
 
+
+    def _on_audio_settings(self):
+        """ Save new audio settings and move a running server to
+            the new device.
+        """
+        self._save_sessionpars()
+        # Reopen devices with the new settings; a running server
+        # also closes them when it restarts
+        playback.close_streams()
+        if self.server is not None and self.server.is_running():
+            self.restart_server()
+
     def _show_calibration_dialog(self):
         """ Display the calibration dialog window
         """
@@ -263,5 +429,7 @@ class Application(tk.Tk):
 
 
 if __name__ == "__main__":
+    # Stimulus indexing starts worker processes; needed when frozen
+    multiprocessing.freeze_support()
     app = Application()
     app.mainloop()
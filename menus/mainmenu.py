@@ -52,6 +52,25 @@ class MainMenu(tk.Menu):
             label="Start Server",
             command=self._event('<<ServerStartServer>>')
         )
+        server_menu.add_command(
+            label="Stop Server",
+            command=self._event('<<ServerStopServer>>')
+        )
+        server_menu.add_command(
+            label="Restart Server",
+            command=self._event('<<ServerRestartServer>>')
+        )
+        server_menu.add_separator()
+        # Choose server engine (takes effect on next start)
+        engine_menu = tk.Menu(server_menu, tearoff=False)
+        for engine in ('selectors', 'asyncio'):
+            engine_menu.add_radiobutton(
+                label=engine,
+                value=engine,
+                variable=parent.sessionpars['Server Engine'],
+                command=self._event('<<ServerEngine>>')
+            )
+        server_menu.add_cascade(label="Engine", menu=engine_menu)
         # Add Server menu to the menubar
         self.add_cascade(label="Server", menu=server_menu, font=("", font_size))
 
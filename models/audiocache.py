@@ -0,0 +1,199 @@
+""" Decoded-audio cache for Socket Audio Player.
+
+    Keeps decoded signals in memory so stimuli that are played
+    again and again are only read from disk once. Entries are
+    keyed by path and checked against the file's size and
+    modification time, so an edited file is read again. The
+    least recently used entries are dropped to stay within a
+    memory budget.
+"""
+
+###########
+# Imports #
+###########
+# Import system packages
+import os
+import threading
+from collections import OrderedDict
+
+# Import audio packages
+import soundfile as sf
+
+
+#########
+# BEGIN #
+#########
+# Default memory budget (bytes)
+MAX_BYTES = 512 * 2**20
+
+# Files whose channel statistics are remembered
+MAX_STATS = 2**16
+
+
+class AudioCache:
+    """ LRU cache of (signal, fs) pairs from soundfile.read(),
+        decoded to float32.
+
+        Cached signals are read-only: copy before modifying.
+    """
+
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        # Path -> (size, mtime, signal, fs), oldest first
+        self._entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Path -> (size, mtime, channel statistics), oldest first.
+        # A few numbers per file, so not counted in the budget.
+        self._stats = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    @staticmethod
+    def _key(file_path):
+        return os.path.abspath(os.fspath(file_path))
+
+
+    def read(self, file_path):
+        """ Return (signal, fs) for a file, from memory if the
+            file is unchanged since it was cached.
+        """
+        key = self._key(file_path)
+        st = os.stat(key)
+        cached = self._lookup(key, st)
+        if cached is not None:
+            return cached
+        with self._lock:
+            self.misses += 1
+
+        # Decode outside the lock so other files can be served
+        signal, fs = sf.read(key, dtype='float32')
+        signal.flags.writeable = False
+        self.put(key, signal, fs, st)
+        return signal, fs
+
+
+    def get(self, file_path):
+        """ Return (signal, fs) if the file is cached and unchanged
+            since, else None. Never reads the file.
+        """
+        key = self._key(file_path)
+        return self._lookup(key, os.stat(key))
+
+
+    def _lookup(self, key, st):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[:2] == (st.st_size, st.st_mtime_ns):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2], entry[3]
+        return None
+
+
+    def put(self, file_path, signal, fs, st=None):
+        """ Add a decoded signal, evicting old entries as needed.
+            Signals larger than the whole budget are not kept.
+        """
+        key = self._key(file_path)
+        if st is None:
+            st = os.stat(key)
+        nbytes = signal.nbytes
+        with self._lock:
+            self._discard(key)
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = (st.st_size, st.st_mtime_ns, signal, fs)
+            self.bytes += nbytes
+            self._trim()
+
+
+    def channel_stats(self, file_path, compute=None):
+        """ Return the channel statistics of a file, calling
+            compute() for them only if the file has changed since
+            they were last computed (or they were never computed).
+            Kept for memory-mapped and streamed files too. Without
+            compute, returns None rather than computing them.
+        """
+        key = self._key(file_path)
+        st = os.stat(key)
+        with self._lock:
+            entry = self._stats.get(key)
+            if entry is not None and entry[:2] == (st.st_size, st.st_mtime_ns):
+                self._stats.move_to_end(key)
+                return entry[2]
+        if compute is None:
+            return None
+
+        stats = compute()
+        with self._lock:
+            self._stats[key] = (st.st_size, st.st_mtime_ns, stats)
+            self._stats.move_to_end(key)
+            while len(self._stats) > MAX_STATS:
+                self._stats.popitem(last=False)
+        return stats
+
+
+    def contains(self, file_path):
+        with self._lock:
+            return self._key(file_path) in self._entries
+
+
+    def evict(self, file_path=None):
+        """ Drop one file, or every file if none is given.
+            Returns the number of bytes freed.
+        """
+        with self._lock:
+            before = self.bytes
+            if file_path is None:
+                self._entries.clear()
+                self.bytes = 0
+            else:
+                self._discard(self._key(file_path))
+            return before - self.bytes
+
+
+    def resize(self, max_bytes):
+        """ Change the memory budget, evicting as needed.
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._trim()
+
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else None,
+            }
+
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = self.evictions = 0
+
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2].nbytes
+
+
+    def _trim(self):
+        while self.bytes > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self.bytes -= entry[2].nbytes
+            self.evictions += 1
+
+
+# Shared by every Audio object in the process
+cache = AudioCache()
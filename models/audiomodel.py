@@ -15,32 +15,70 @@ import matplotlib.pyplot as plt
 
 # Import system packages
 import os
+import time
 
 # Import audio packages
-import soundfile as sf
 import sounddevice as sd
+import soundfile as sf
 
 # Import GUI packages
 from tkinter import messagebox
 
+# Import custom modules
+from models import audiocache
+from models import latency
+from models import playback
+from models import stimindex
+from models import wavmap
+
 
 #########
 # BEGIN #
 #########
+# WAV files at least this big are memory-mapped instead of decoded
+MEMMAP_MIN_BYTES = 32 * 2**20
+
+# Other files at least this big are streamed from disk
+STREAM_MIN_BYTES = 32 * 2**20
+
+# Read-ahead buffer for streamed files (seconds)
+STREAM_BUFFER_SECONDS = 2.0
+
+
 class Audio:
     """ Class for use with .wav files.
     """
 
-    def __init__(self, file_path):
+    def __init__(self, file_path, interactive=True, stream=None):
         """ Read audio file and generate info.
 
             file_path: a Path object from pathlib
+            interactive: show dialogs and plots on clipping. Set
+                to False when not running on the Tk main thread.
+            stream: True to play the file straight from disk,
+                False never to, None to stream large files that
+                cannot be memory-mapped
+
+            Large PCM WAV files are memory-mapped: self.signal is
+            then a read-only np.memmap of the raw samples, and
+            self.mapped holds their scaling (see models.wavmap).
+            Streamed files are not read until played, and
+            self.signal is None. A file already in the cache (e.g.
+            preloaded) is played from there unless stream is True.
         """
         print(f"\naudiomodel: Attempting to load {os.path.basename(file_path)}...")
         # Parse file path
         self.directory = os.path.split(file_path)[0]
         self.name = os.path.basename(file_path)
         self.file_path = file_path
+        self.interactive = interactive
+
+        # Stream player for the current presentation
+        self.player = None
+
+        # False if play() could not check its level for clipping
+        # in advance (see _mapped_source())
+        self.level_checked = True
 
          # Read audio file
         file_exists = os.access(self.file_path, os.F_OK)
@@ -48,107 +86,332 @@ class Audio:
             print("audiomodel: Audio file not found!")
             raise FileNotFoundError
         else:
-            self.signal, self.fs = sf.read(self.file_path)
+            # Decoded signals are shared through the cache and
+            # read-only; play() scales them as they are played
+            start = time.perf_counter()
+            cached = None if stream else audiocache.cache.get(self.file_path)
+            self.mapped = None if stream or cached else self._map()
+            self.streamed = not cached and self.mapped is None \
+                and self._streamable(stream)
+            if cached:
+                print("audiomodel: Found in cache")
+                self.signal, self.fs = cached
+            elif self.mapped is not None:
+                print("audiomodel: Memory-mapped")
+                self.signal, self.fs = self.mapped.data, self.mapped.fs
+            elif self.streamed:
+                print("audiomodel: Streaming from disk")
+                info = sf.info(self.file_path)
+                self.signal, self.fs = None, info.samplerate
+            else:
+                self.signal, self.fs = audiocache.cache.read(self.file_path)
+            latency.record("file_read", time.perf_counter() - start)
             print("audiomodel: Found!")
             print(f"audiomodel: Sampling rate: {self.fs}")
 
         # Get number of channels
-        try:
-            self.num_channels = self.signal.shape[1]
-        except IndexError:
-            self.num_channels = 1
+        if self.streamed:
+            self.num_channels = info.channels
+        else:
+            try:
+                self.num_channels = self.signal.shape[1]
+            except IndexError:
+                self.num_channels = 1
         self.channels = np.array(range(1, self.num_channels+1))
         print(f"audiomodel: Number of channels in file: {self.num_channels}")
 
         # Assign audio file attributes
-        self.dur = len(self.signal) / self.fs
-        self.t = np.arange(0, self.dur, 1/self.fs)
+        self.frames = info.frames if self.streamed else len(self.signal)
+        self.dur = self.frames / self.fs
         print(f"audiomodel: Duration: {np.round(self.dur, 2)} seconds " +
             f"({np.round(self.dur/60, 2)} minutes)")
 
-        # Get data type
-        self.data_type = self.signal.dtype
+        # Get data type (streamed files are decoded to float32)
+        if self.streamed:
+            self.data_type = np.dtype(np.float32)
+        else:
+            self.data_type = self.signal.dtype
         print(f"audiomodel: Data type: {self.data_type}")
 
 
-    def play(self, level=None, device_id=None):
-        """ Present audio
+    def _map(self):
+        """ Memory-map the file if it is a large WAV numpy can
+            read directly. Returns a wavmap.MappedWav or None.
         """
-        print("\naudiomodel: Preparing to present audio...")
-        # Create a temporary signal to be modified
-        temp = self.signal.copy()
-        temp = temp.astype(np.float32)
+        try:
+            if os.path.getsize(self.file_path) < MEMMAP_MIN_BYTES:
+                return None
+            return wavmap.open_memmap(self.file_path)
+        except (OSError, ValueError):
+            return None
+
+
+    def _streamable(self, stream):
+        """ Whether to stream the file from disk rather than
+            decode it up front.
+        """
+        if stream is not None:
+            return bool(stream)
+        try:
+            return os.path.getsize(self.file_path) >= STREAM_MIN_BYTES
+        except OSError:
+            return False
+
+
+    @property
+    def t(self):
+        """ Sample times (s), built on demand.
+        """
+        return np.arange(self.frames) / self.fs
 
-        # Assign audio device defaults
-        sd.default.device = device_id
-        sd.default.samplerate = self.fs
-        #sd.default.channels = self.num_channels
 
-        # Get number of available audio device channels
-        self.num_outputs = sd.query_devices(sd.default.device)['max_output_channels']
+    def play(self, level=None, device_id=None, info=None, start_at=None):
+        """ Present audio
+
+            info: extra fields to include in playback events
+                (see models.playback)
+            start_at: time.monotonic() at which playback should
+                start; None to start at once
+        """
+        print("\naudiomodel: Preparing to present audio...")
+        # Query the output device directly rather than through
+        # sd.default, so players on other devices are unaffected
+        device = sd.query_devices(device_id, 'output')
+        self.num_outputs = device['max_output_channels']
 
         # Display audio device features to console
-        print(f"audiomodel: Audio device: {sd.query_devices(sd.default.device)['name']}")
+        print(f"audiomodel: Audio device: {device['name']}")
         print(f"audiomodel: Device outputs: {self.num_outputs}")
 
         # Set presentation level
-        if level == None:
-            # Normalize if no level is provided
-            print("audiomodel: No level provided, normalizing...")
-            for chan in range(0, self.num_channels):
-                temp[:, chan] = temp[:, chan] - np.mean(temp[:, chan]) # remove DC offset
-                temp[:, chan] = temp[:, chan] / np.max(np.abs(temp[:, chan])) # normalize
-                temp[:, chan] = temp[:, chan] / self.num_channels # account for num channels
-                #print(f"\nMax of signal: {np.max(np.abs(self.signal[:, chan]))}")
-                #print(f"Max of temp: {np.max(np.abs(temp[:, chan]))}")
+        start = time.perf_counter()
+        self.level_checked = True
+        if self.mapped is not None:
+            source = self._mapped_source(level)
+        elif self.streamed:
+            source = self._file_source(level)
         else:
-            # Convert level in dB to magnitude
-            mag = self.db2mag(level)
-            # Apply scaling factor to temp
-            temp = temp * mag
-            # try:
-            #     # Apply scaling factor to each channel
-            #     print(f"audiomodel: Applying scaling factor of {level} to each channel...")
-            #     for chan in range(0, self.num_channels):
-            #         temp[:, chan] = temp[:, chan] * level
-            #         #print(f"\nMax of signal: {np.max(np.abs(self.signal[:, chan]))}")
-            #         #print(f"Max of temp: {np.max(np.abs(temp[:, chan]))}")
-            # except IndexError:
-            #     temp = temp * level
-
-        print(f"audiomodel: Audio shape: {temp.shape}")
-
-        # Check for clipping after level has been applied
-        if np.max(np.abs(temp)) > 0.999:
-            self._clipping(temp)
+            source = self._array_source(level)
+        latency.record("level", time.perf_counter() - start)
 
         # Present audio
         print("audiomodel: Attempting to present audio...")
+        # Only one stimulus plays at a time on each device (as
+        # with sd.play)
+        playback.stop_all(device=device_id)
+        try:
+            self.player = playback.StreamPlayer(
+                source,
+                samplerate=self.fs,
+                channels=source.channels,
+                device=device_id,
+                info=info,
+                start_at=start_at,
+            )
+            self.player.start()
+        except Exception as e:
+            print(e)
+            self.player = None
+            # Stop a streamed file's reader
+            if hasattr(source, 'close'):
+                source.close()
+            # Let the server report the failure
+            if not self.interactive:
+                raise
+        print("audiomodel: Done")
+
+
+    def _scaling(self, level, check=True):
+        """ Per-channel (offsets, gains) taking the samples, as
+            floats, to the output: the level as a gain or, if level
+            is None, DC removal, peak normalization and division by
+            the number of channels, so the result peaks at
+            1/num_channels of full scale. With a level the result
+            is checked for clipping, unless check is False.
+        """
+        if level == None:
+            # Normalize if no level is provided
+            print("audiomodel: No level provided, normalizing...")
+            stats = self._channel_stats()
+            mean, low, high = stats['mean'], stats['min'], stats['max']
+            peak = np.maximum(high - mean, mean - low)
+            # Leave silent channels alone
+            peak[peak == 0] = 1.0
+            return mean, 1 / (peak * self.num_channels)
+
+        # Convert level in dB to magnitude
+        mag = self.db2mag(level)
+        if check:
+            self._check_level(mag, self._channel_stats())
+        return np.zeros(self.num_channels), np.full(self.num_channels, mag)
+
+
+    def _check_level(self, mag, stats):
+        """ Raise (after a dialog, if interactive) if a gain of mag
+            would push the samples past full scale.
+        """
+        if np.max(np.maximum(stats['max'], -stats['min'])) * mag > 0.999:
+            # Only decoded files are plotted
+            decoded = self.mapped is None and not self.streamed
+            self._clipping(self.signal * np.float32(mag)
+                if decoded else None)
+
+
+    def _known_stats(self):
+        """ Channel statistics if they are available without
+            reading the audio: from the audio cache or a current
+            stimulus index. Otherwise None.
+        """
+        stats = audiocache.cache.channel_stats(self.file_path)
+        if stats is None:
+            indexed = stimindex.lookup(self.file_path)
+            if indexed is not None \
+                and len(indexed['mean']) == self.num_channels:
+                # Remember them like computed ones
+                stats = self._channel_stats()
+        return stats
+
+
+    def _unscanned_check(self, level):
+        """ Clip check for sources that must not read the whole
+            file before playing. Checks the level if the statistics
+            are already known, and otherwise records in
+            self.level_checked that it could not. Returns True if
+            the source should clip and count samples as it plays.
+        """
+        if level is None:
+            # Normalized output cannot exceed full scale
+            return False
+        stats = self._known_stats()
+        if stats is None:
+            print("audiomodel: Level not checked in advance; clipped "
+                "samples will be counted")
+            self.level_checked = False
+            return True
+        self._check_level(self.db2mag(level), stats)
+        return False
+
+
+    def _channel_stats(self):
+        """ Dict of per-channel 'mean', 'min' and 'max' of the
+            samples as floats ('rms' too if taken from a stimulus
+            index). Computed once per version of the file and then
+            taken from the audio cache.
+        """
+        return audiocache.cache.channel_stats(
+            self.file_path, self._scan_channels)
+
+
+    def _scan_channels(self):
+        """ Compute the statistics for _channel_stats(), unless the
+            file's stimulus index (see models.stimindex) has them.
+        """
+        stats = stimindex.lookup(self.file_path)
+        if stats is not None and len(stats['mean']) == self.num_channels:
+            print("audiomodel: Statistics from stimulus index")
+            return stats
+
+        if self.mapped is not None:
+            mapped = self.mapped
+            mean, low, high = ((values - mapped.offset) / mapped.full_scale
+                for values in wavmap.channel_stats(mapped))
+            return {'mean': mean, 'min': low, 'max': high}
+
+        if self.streamed:
+            # Read block by block
+            return stimindex.file_stats(self.file_path)
+
+        # One vectorized pass per statistic; mono signals are 1-D
+        signal = self.signal.reshape(self.frames, self.num_channels)
+        return {
+            'mean': signal.mean(axis=0, dtype=np.float64),
+            'min': signal.min(axis=0).astype(np.float64),
+            'max': signal.max(axis=0).astype(np.float64),
+        }
+
+
+    def channel_rms(self):
+        """ RMS of each channel, from the stimulus index or the
+            cached statistics where possible, so the signal is
+            scanned at most once.
+        """
+        stats = self._channel_stats()
+        if 'rms' not in stats:
+            if self.mapped is None and not self.streamed:
+                signal = self.signal.reshape(self.frames, self.num_channels)
+                squares = np.einsum('ij,ij->j', signal, signal,
+                    dtype=np.float64)
+                stats['rms'] = np.sqrt(squares / max(self.frames, 1))
+            else:
+                stats['rms'] = stimindex.file_stats(self.file_path)['rms']
+        return stats['rms']
+
+
+    def _array_source(self, level):
+        """ Source playing the decoded signal. Offsets and gains
+            are applied block by block in the output callback, so
+            nothing the size of the file is allocated.
+        """
+        # Output stream needs (frames, channels); a view
+        signal = self.signal.reshape(self.frames, self.num_channels)
+        print(f"audiomodel: Audio shape: {signal.shape}")
+
+        offsets, gains = self._scaling(level)
+        channels = self._output_channels()
+        return playback.ArraySource(signal[:, :channels],
+            offsets=offsets[:channels], gains=gains[:channels])
+
+
+    def _mapped_source(self, level):
+        """ Source converting the memory-mapped samples block by
+            block as they are played. A level is checked against
+            known statistics only (see _unscanned_check()), since
+            scanning would read the whole file.
+        """
+        mapped = self.mapped
+        clip = self._unscanned_check(level)
+        offsets, gains = self._scaling(level, check=False)
+        # Apply to raw samples
+        offsets = mapped.offset + offsets * mapped.full_scale
+        gains = gains / mapped.full_scale
+
+        channels = self._output_channels()
+        return playback.MappedSource(
+            mapped.data, offsets[:channels], gains[:channels], clip=clip)
+
+
+    def _file_source(self, level):
+        """ Source reading the file from disk as it is played.
+            With a level, playback starts at once; the level is
+            checked as for memory-mapped files. Normalizing needs
+            the statistics of the whole file first.
+        """
+        clip = self._unscanned_check(level)
+        offsets, gains = self._scaling(level, check=False)
+        channels = self._output_channels()
+        return playback.FileSource(
+            self.file_path, offsets[:channels], gains[:channels],
+            buffer_frames=int(STREAM_BUFFER_SECONDS * self.fs), clip=clip)
+
+
+    def _output_channels(self):
+        """ Number of file channels the device can play.
+        """
         # Check that audio device has enough channels for audio
         if self.num_outputs < self.num_channels:
             print(f"\naudiomodel: {self.num_channels}-channel file, but "
                 f"only {self.num_outputs} audio device output channels!")
             print("audiomodel: Dropping " +
                 f"{self.num_channels - self.num_outputs} audio file channels")
-            try:
-                sd.play(temp[:, 0:self.num_outputs])
-                #sd.wait(self.dur+0.5)
-            except Exception as e:
-                print(e)
-            print("audiomodel: Done")
-        else:
-            try:
-                sd.play(temp)
-                #sd.wait(self.dur+0.5)
-            except Exception as e:
-                print(e)
-            print("audiomodel: Done")
+            return self.num_outputs
+        return self.num_channels
 
 
     def stop(self):
         """ Stop audio presentation.
         """
-        sd.stop()
+        if self.player is not None:
+            self.player.stop()
 
 
     def plot_wave(self, sig):
@@ -162,13 +425,17 @@ class Audio:
 
 
     def _clipping(self, temp):
+        if not self.interactive:
+            raise Exception("audiomodel: Clipping occurred")
         messagebox.showerror(
             title="Clipping",
             message="The level provided is too high. Enter a lower level.",
             detail="The waveform will be plotted when this message is " +
                 "closed for visual inspection."
         )
-        self.plot_wave(temp)
+        # Memory-mapped files are not loaded just to be plotted
+        if temp is not None:
+            self.plot_wave(temp)
         raise Exception("audiomodel: Clipping occurred")
 
 
@@ -0,0 +1,146 @@
+""" Latency histograms for Socket Audio Player.
+
+    Stages of the request path call record() with a duration in
+    seconds. Each stage keeps a fixed set of log-spaced buckets,
+    so recording is constant time and memory no matter how many
+    requests are served. snapshot() summarizes every stage for
+    the 'stats' action and reset() clears them.
+"""
+
+###########
+# Imports #
+###########
+# Import system packages
+import math
+import threading
+
+
+#########
+# BEGIN #
+#########
+# Stages in request order, used to order snapshot()
+STAGES = (
+    "accept",
+    "header",
+    "body",
+    "action",
+    "file_read",
+    "level",
+    "stream_open",
+    "first_callback",
+)
+
+# Buckets per doubling of duration: bucket edges are ~19% apart
+BUCKETS_PER_OCTAVE = 4
+
+# Smallest resolved duration (seconds); shorter ones share the
+# first bucket
+MIN_SECONDS = 1e-6
+
+# Durations from MIN_SECONDS up to ~2**30 times that (~18 min)
+NUM_BUCKETS = 30 * BUCKETS_PER_OCTAVE
+
+# Percentiles reported by Histogram.summary()
+PERCENTILES = (50, 90, 99)
+
+# Histograms by stage name
+_histograms = {}
+_lock = threading.Lock()
+
+
+class Histogram:
+    """ Log-bucketed histogram of durations in seconds.
+    """
+
+    def __init__(self):
+        self.counts = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+
+    def add(self, seconds):
+        if seconds > MIN_SECONDS:
+            index = int(math.log2(seconds / MIN_SECONDS) * BUCKETS_PER_OCTAVE)
+            index = min(index, NUM_BUCKETS - 1)
+        else:
+            index = 0
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+
+    @staticmethod
+    def upper_edge(index):
+        """ Largest duration (seconds) counted in a bucket.
+        """
+        return MIN_SECONDS * 2 ** ((index + 1) / BUCKETS_PER_OCTAVE)
+
+
+    def percentile(self, p):
+        """ Estimate the p-th percentile (seconds) as the upper
+            edge of the bucket it falls in, capped at the largest
+            duration seen.
+        """
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(self.upper_edge(index), self.max)
+        return self.max
+
+
+    def summary(self):
+        """ Count plus mean, min, max and percentiles in ms.
+        """
+        if not self.count:
+            return {"count": 0}
+        summary = {
+            "count": self.count,
+            "mean_ms": _ms(self.total / self.count),
+            "min_ms": _ms(self.min),
+            "max_ms": _ms(self.max),
+        }
+        for p in PERCENTILES:
+            summary[f"p{p}_ms"] = _ms(self.percentile(p))
+        return summary
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3)
+
+
+def record(stage, seconds):
+    """ Add one duration (seconds) to a stage's histogram. Safe
+        to call from any thread.
+    """
+    with _lock:
+        try:
+            histogram = _histograms[stage]
+        except KeyError:
+            histogram = _histograms[stage] = Histogram()
+        histogram.add(seconds)
+
+
+def snapshot():
+    """ Return a summary dict for every stage recorded so far.
+    """
+    with _lock:
+        stages = sorted(
+            _histograms,
+            key=lambda s: STAGES.index(s) if s in STAGES else len(STAGES)
+        )
+        return {stage: _histograms[stage].summary() for stage in stages}
+
+
+def reset():
+    """ Forget all recorded durations.
+    """
+    with _lock:
+        _histograms.clear()
@@ -0,0 +1,867 @@
+""" Stream-based playback for Socket Audio Player.
+
+    StreamPlayer pulls blocks from a source object in a
+    sounddevice OutputStream callback. Sources provide
+    read_into(outdata) and return the number of frames written;
+    a short block ends playback unless the source has set its
+    `starved` flag (it ran dry, silenced the rest, and expects
+    more).
+    Players share one persistent stream per device (DeviceStream)
+    unless configure() says otherwise.
+
+    Functions registered with add_listener() are called with an
+    event dict whenever a player finishes, is stopped, or
+    underruns. stop_all() stops every player, like sd.stop().
+"""
+
+###########
+# Imports #
+###########
+# Import data science packages
+import numpy as np
+
+# Import system packages
+import threading
+import time
+from collections import deque
+
+# Import audio packages
+import sounddevice as sd
+import soundfile as sf
+
+# Import custom modules
+from models import latency
+
+
+#########
+# BEGIN #
+#########
+# Players currently running
+_active = set()
+
+# Finished players whose streams still need closing
+_finished = []
+
+# Called with an event dict when a player finishes, is stopped,
+# or underruns
+_listeners = []
+
+
+def add_listener(func):
+    _listeners.append(func)
+
+
+def remove_listener(func):
+    try:
+        _listeners.remove(func)
+    except ValueError:
+        pass
+
+
+def _notify(event):
+    for func in list(_listeners):
+        try:
+            func(event)
+        except Exception as e:
+            print(f"playback: Error: listener failed: {e!r}")
+
+
+# Output stream settings (see configure())
+_settings = {
+    'persistent': True,
+    'blocksize': 0,
+    'latency': 'high',
+    'preroll': 0.05,
+}
+
+# Persistent DeviceStreams by device ID
+_streams = {}
+_streams_lock = threading.Lock()
+
+
+def configure(persistent=None, blocksize=None, latency=None, preroll=None):
+    """ Change output stream settings for players created from
+        now on. Arguments left as None are unchanged.
+
+        persistent: play through one long-lived stream per device
+            (True) or open a stream for every stimulus (False)
+        blocksize: frames per callback; 0 lets the host choose
+        latency: suggested output latency in seconds, or 'low' or
+            'high' for the device defaults
+        preroll: seconds of silence a new persistent stream plays
+            before its first stimulus
+
+        Open persistent streams are closed, so the next stimulus
+        opens one with the new settings.
+    """
+    for key, value in (('persistent', persistent),
+        ('blocksize', blocksize), ('latency', latency),
+        ('preroll', preroll)):
+        if value is not None:
+            _settings[key] = value
+    close_streams()
+
+
+# Default for stop_all(): None is itself a device (the default)
+_ANY_DEVICE = object()
+
+
+def stop_all(device=_ANY_DEVICE):
+    """ Stop every running player, or only those on device.
+    """
+    for player in list(_active):
+        if device is _ANY_DEVICE or player.device == device:
+            player.stop()
+
+
+# Supported raw PCM sample formats and their full-scale values
+PCM_FORMATS = {
+    'float32': (np.dtype('<f4'), 1.0),
+    'int16': (np.dtype('<i2'), 32768.0),
+}
+
+
+class JitterBuffer:
+    """ FIFO of float32 blocks between a network reader and the
+        output callback.
+
+        The callback zero-fills (and counts an underrun) when the
+        writer falls behind. Once close() is called and the
+        buffer is empty, read_into() returns short and playback
+        ends.
+
+        max_frames: frames at which the buffer counts as full.
+            write() never blocks or drops audio; writers check
+            `full` and wait before writing more.
+        underruns: times the buffer ran dry; a run of starved
+            blocks counts once
+    """
+
+    def __init__(self, channels, max_frames=None):
+        self.channels = channels
+        self.max_frames = max_frames
+        self._blocks = deque()
+        self._offset = 0
+        self._frames = 0
+        self._lock = threading.Lock()
+        self.closed = False
+        self.starved = False
+        self.underruns = 0
+
+
+    @property
+    def frames(self):
+        """ Number of frames waiting to be played.
+        """
+        return self._frames
+
+
+    @property
+    def full(self):
+        """ True while max_frames or more are waiting.
+        """
+        return self.max_frames is not None and self._frames >= self.max_frames
+
+
+    def write(self, block):
+        """ Append a (frames, channels) float32 block.
+        """
+        with self._lock:
+            self._blocks.append(block)
+            self._frames += len(block)
+
+
+    def close(self):
+        """ No more blocks will be written.
+        """
+        self.closed = True
+
+
+    def read_into(self, outdata):
+        """ Fill outdata from the buffer. Returns the number of
+            frames written; short at the end of input, or with
+            self.starved set if the writer fell behind.
+        """
+        wanted = len(outdata)
+        filled = 0
+        with self._lock:
+            while filled < wanted and self._blocks:
+                block = self._blocks[0]
+                n = min(wanted - filled, len(block) - self._offset)
+                outdata[filled:filled + n] = \
+                    block[self._offset:self._offset + n]
+                filled += n
+                self._offset += n
+                if self._offset == len(block):
+                    self._blocks.popleft()
+                    self._offset = 0
+            self._frames -= filled
+        if filled < wanted:
+            outdata[filled:] = 0
+        # Writer fell behind: play silence and carry on
+        starved = filled < wanted and not self.closed
+        if starved and not self.starved:
+            self.underruns += 1
+        self.starved = starved
+        return filled
+
+
+class ArraySource:
+    """ Source reading from a (frames, channels) float32 array.
+
+        offsets, gains: optional per-channel values subtracted from
+            and factors applied to each block as it is copied out,
+            so the array itself (which may be shared and read-only)
+            is never modified or copied
+    """
+
+    def __init__(self, data, offsets=None, gains=None):
+        self.data = data
+        self.channels = data.shape[1]
+        self.offsets = None if offsets is None or not np.any(offsets) \
+            else np.asarray(offsets, dtype=np.float32)
+        self.gains = None if gains is None \
+            else np.asarray(gains, dtype=np.float32)
+        self.position = 0
+
+
+    def read_into(self, outdata):
+        frames = min(len(outdata), len(self.data) - self.position)
+        block = self.data[self.position:self.position + frames]
+        out = outdata[:frames]
+        if self.offsets is not None:
+            np.subtract(block, self.offsets, out=out)
+            block = out
+        if self.gains is None:
+            out[:] = block
+        else:
+            np.multiply(block, self.gains, out=out)
+        self.position += frames
+        return frames
+
+
+class MappedSource:
+    """ Source converting raw samples (e.g. an np.memmap of a
+        WAV file) to float32 one block at a time, so only the
+        part being played is ever read or converted.
+
+        data: (frames, channels) array of raw samples; extra
+            channels beyond len(gains) are ignored
+        offsets: per-channel value subtracted from each sample
+        gains: per-channel factor applied after the offset
+        clip: clip samples pushed past full scale by the gain,
+            counting them in self.clipped
+
+        Normalized signals cannot exceed full scale, so callers
+        pass clip=False for them.
+    """
+
+    def __init__(self, data, offsets, gains, clip=True):
+        self.data = data
+        self.channels = len(gains)
+        self.offsets = np.asarray(offsets, dtype=np.float32)
+        self.gains = np.asarray(gains, dtype=np.float32)
+        self.clip = clip
+        self.position = 0
+        self.clipped = 0
+
+
+    def read_into(self, outdata):
+        frames = min(len(outdata), len(self.data) - self.position)
+        block = self.data[self.position:self.position + frames,
+            :self.channels]
+        out = outdata[:frames]
+        np.subtract(block, self.offsets, out=out, casting='unsafe')
+        np.multiply(out, self.gains, out=out)
+        if self.clip and frames and max(out.max(), -out.min()) > 0.999:
+            self.clipped += int(np.count_nonzero(np.abs(out) > 0.999))
+            np.clip(out, -0.999, 0.999, out=out)
+        self.position += frames
+        return frames
+
+
+class FileSource:
+    """ Source streaming a sound file from disk.
+
+        A read-ahead thread decodes blocks into a ring buffer of
+        fixed size and the callback only copies out of it, so
+        memory use depends on the buffer, not the file length.
+        The first block is read before the constructor returns,
+        so playback can start at once. If the reader falls
+        behind, the callback plays silence and counts an
+        underrun (once for a run of starved blocks).
+
+        offsets, gains: per-channel offset and gain, as for
+            MappedSource; file channels beyond len(gains) are
+            ignored
+        buffer_frames: size of the ring buffer
+        block_frames: frames decoded per read
+        clip: clip and count samples past full scale, as for
+            MappedSource
+    """
+
+    def __init__(self, file_path, offsets, gains, buffer_frames=2**17,
+        block_frames=2**12, clip=True):
+        self.file = sf.SoundFile(file_path)
+        self.channels = len(gains)
+        self.offsets = np.asarray(offsets, dtype=np.float32)
+        self.gains = np.asarray(gains, dtype=np.float32)
+        self.clip = clip
+        self.block_frames = block_frames
+        self.buffer_frames = max(buffer_frames, 2 * block_frames)
+        self._ring = np.zeros(
+            (self.buffer_frames, self.channels), dtype=np.float32)
+        self._block = np.zeros(
+            (block_frames, self.file.channels), dtype=np.float32)
+        # Total frames written by the reader and read by the
+        # callback; the ring holds the frames between them
+        self._written = 0
+        self._read = 0
+        self._cond = threading.Condition()
+        self.eof = False
+        self.closed = False
+        self.starved = False
+        self.underruns = 0
+        self.clipped = 0
+
+        if not self._fill():
+            self._finish()
+        else:
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                name="playback-reader")
+            self._thread.start()
+
+
+    def _fill(self):
+        """ Decode one block into the ring. Returns the number of
+            frames added, 0 at the end of the file.
+        """
+        block = self.file.read(self.block_frames, dtype='float32',
+            always_2d=True, out=self._block)[:, :self.channels]
+        frames = len(block)
+        if not frames:
+            return 0
+        block -= self.offsets
+        block *= self.gains
+        if self.clip and max(block.max(), -block.min()) > 0.999:
+            self.clipped += int(np.count_nonzero(np.abs(block) > 0.999))
+            np.clip(block, -0.999, 0.999, out=block)
+
+        # Only the free part of the ring is written, so the copy
+        # can happen outside the lock
+        start = self._written % self.buffer_frames
+        first = min(frames, self.buffer_frames - start)
+        self._ring[start:start + first] = block[:first]
+        self._ring[:frames - first] = block[first:]
+        with self._cond:
+            self._written += frames
+        return frames
+
+
+    def _run(self):
+        try:
+            while True:
+                with self._cond:
+                    while not self.closed and (self._written - self._read
+                        > self.buffer_frames - self.block_frames):
+                        self._cond.wait()
+                    if self.closed:
+                        break
+                if not self._fill():
+                    break
+        except Exception as e:
+            print(f"playback: Error: reading {self.file.name} failed: {e!r}")
+        finally:
+            self._finish()
+
+
+    def _finish(self):
+        with self._cond:
+            self.eof = True
+        self.file.close()
+
+
+    def read_into(self, outdata):
+        wanted = len(outdata)
+        with self._cond:
+            available = self._written - self._read
+            eof = self.eof
+        frames = min(wanted, available)
+        start = self._read % self.buffer_frames
+        first = min(frames, self.buffer_frames - start)
+        outdata[:first] = self._ring[start:start + first]
+        outdata[first:frames] = self._ring[:frames - first]
+        with self._cond:
+            self._read += frames
+            self._cond.notify()
+        if frames < wanted:
+            outdata[frames:] = 0
+        # Reader fell behind: play silence and carry on
+        starved = frames < wanted and not eof
+        if starved and not self.starved:
+            self.underruns += 1
+        self.starved = starved
+        return frames
+
+
+    def close(self):
+        """ Stop the reader thread and close the file.
+        """
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+
+
+class DeviceStream:
+    """ Long-lived output stream for one device.
+
+        Plays silence until a player is queued with play(), then
+        pulls blocks from it; starting, stopping and replacing
+        stimuli are commands the callback carries out at the next
+        block boundary, so the device is only opened once. A new
+        stream plays `preroll` seconds of silence before taking
+        its first command, letting the host API settle.
+
+        channels: channels the stream is opened with; players
+            with fewer play on the first ones and the rest are
+            silent
+    """
+
+    def __init__(self, device, samplerate, channels):
+        self.device = device
+        self.samplerate = samplerate
+        self.channels = channels
+        # Player being rendered, and commands from other threads
+        self.player = None
+        self._commands = deque()
+        self._preroll_frames = int(_settings['preroll'] * samplerate)
+        self.stream = sd.OutputStream(
+            samplerate=samplerate,
+            channels=channels,
+            dtype='float32',
+            device=device,
+            blocksize=_settings['blocksize'],
+            latency=_settings['latency'],
+            callback=self._callback,
+        )
+        self.stream.start()
+
+
+    def play(self, player):
+        """ Replace whatever is playing with player.
+        """
+        self._commands.append(('play', player))
+
+
+    def stop(self, player):
+        """ Stop player if it is (or is about to be) playing.
+        """
+        self._commands.append(('stop', player))
+
+
+    def _callback(self, outdata, frames, time_info, status):
+        if self._preroll_frames > 0:
+            self._preroll_frames -= frames
+            outdata[:] = 0
+            return
+        while self._commands:
+            command, player = self._commands.popleft()
+            if command == 'play':
+                self._end(self.player, stopped=True)
+                self.player = player
+            elif player is self.player:
+                self._end(player, stopped=True)
+
+        player = self.player
+        if player is None:
+            outdata[:] = 0
+            return
+        if player.channels < self.channels:
+            outdata[:, player.channels:] = 0
+            outdata = outdata[:, :player.channels]
+        try:
+            done = player._render(outdata, frames, time_info, status)
+        except Exception as e:
+            # Keep the stream alive for the next stimulus
+            print(f"playback: Error: {e!r}")
+            outdata[:] = 0
+            done = True
+        if done:
+            self._end(player)
+
+
+    def _end(self, player, stopped=False):
+        if player is None:
+            return
+        if player is self.player:
+            self.player = None
+        if stopped:
+            player._stopped = True
+        player._on_finished()
+
+
+    def close(self):
+        """ Close the stream, ending any queued or current player.
+        """
+        self.stream.close(ignore_errors=True)
+        self._end(self.player, stopped=True)
+        while self._commands:
+            command, player = self._commands.popleft()
+            self._end(player, stopped=True)
+
+
+def _device_stream(device, samplerate, channels):
+    """ The persistent stream for device, (re)opened if it is
+        missing, runs at another rate or has too few channels.
+        It is opened with all of the device's outputs, so
+        stimuli with different channel counts share it.
+    """
+    with _streams_lock:
+        output = _streams.get(device)
+        if output is not None:
+            if output.samplerate == samplerate \
+                and output.channels >= channels \
+                and not output.stream.closed:
+                return output
+            output.close()
+        outputs = sd.query_devices(device, 'output')['max_output_channels']
+        output = DeviceStream(device, samplerate, max(channels, outputs))
+        _streams[device] = output
+        return output
+
+
+def close_streams():
+    """ Close every persistent stream.
+    """
+    with _streams_lock:
+        for output in _streams.values():
+            output.close()
+        _streams.clear()
+
+
+class StreamPlayer:
+    """ Play a source through an OutputStream.
+
+        By default the player is queued on the device's
+        persistent DeviceStream; with persistent=False (or after
+        configure(persistent=False)) it opens a stream of its own,
+        which is closed when playback ends.
+
+        info: extra fields (file path, job ID, ...) to include in
+            this player's events
+        start_at: time.monotonic() at which the first sample
+            should reach the DAC. The stream is started at once
+            and plays silence until then, so the onset is accurate
+            to a sample rather than to a callback. A 'started'
+            event reports the actual onset.
+    """
+
+    def __init__(self, source, samplerate, channels, device=None,
+        info=None, start_at=None, persistent=None):
+        self.source = source
+        self.info = dict(info or {})
+        self.samplerate = samplerate
+        self.channels = channels
+        self.device = device
+        self.start_at = start_at
+        # Stream clock minus time.monotonic(), measured by start()
+        self._clock_offset = 0.0
+        # Source frames delivered, not counting silence
+        self.frames_played = 0
+        self._device_underruns = 0
+        self._underflowing = False
+        self._reported_underruns = 0
+        self._stopped = False
+        # Set by start(); a player stopped before then never plays
+        self._started = False
+        self._start_lock = threading.Lock()
+        self.finished = threading.Event()
+        # perf_counter() when start() was called, until the first
+        # callback
+        self._started_at = None
+        self._open_seconds = 0.0
+        if persistent is None:
+            persistent = _settings['persistent']
+        start = time.perf_counter()
+        if persistent:
+            # Shared stream; only opened if the device has none
+            self.output = _device_stream(device, samplerate, channels)
+            self.stream = self.output.stream
+        else:
+            self.output = None
+            self.stream = sd.OutputStream(
+                samplerate=samplerate,
+                channels=channels,
+                dtype='float32',
+                device=device,
+                blocksize=_settings['blocksize'],
+                latency=_settings['latency'],
+                callback=self._callback,
+                finished_callback=self._on_finished,
+            )
+        self._open_seconds = time.perf_counter() - start
+
+
+    @property
+    def underruns(self):
+        """ Device underflows plus times the source ran dry. A run
+            of affected blocks counts once.
+        """
+        return self._device_underruns + getattr(self.source, 'underruns', 0)
+
+
+    def _event(self, name):
+        event = {
+            "event": name,
+            "frames": self.frames_played,
+            "underruns": self.underruns,
+        }
+        clipped = getattr(self.source, 'clipped', 0)
+        if clipped:
+            event["clipped"] = clipped
+        event.update(self.info)
+        return event
+
+
+    def _callback(self, outdata, frames, time_info, status):
+        if self._render(outdata, frames, time_info, status):
+            raise sd.CallbackStop
+
+
+    def _render(self, outdata, frames, time_info, status):
+        """ Fill one block. Returns True once the source has run
+            out.
+        """
+        if self._started_at is not None:
+            latency.record(
+                "first_callback", time.perf_counter() - self._started_at)
+            self._started_at = None
+        if status.output_underflow and not self._underflowing:
+            self._device_underruns += 1
+        self._underflowing = bool(status.output_underflow)
+        skip = 0
+        if self.start_at is not None:
+            skip = self._preroll(outdata, frames, time_info)
+            if skip == frames:
+                return False
+        written = self.source.read_into(outdata[skip:])
+        self.frames_played += written
+        written += skip
+        if self.underruns > self._reported_underruns:
+            self._reported_underruns = self.underruns
+            _notify(self._event('underrun'))
+        if written < frames:
+            outdata[written:] = 0
+            return not getattr(self.source, 'starved', False)
+        return False
+
+
+    def _preroll(self, outdata, frames, time_info):
+        """ Silence the part of this block before start_at. Returns
+            the number of frames silenced, and sends the 'started'
+            event once the onset falls in this block.
+        """
+        start_at = self.start_at
+        dac_time = time_info.outputBufferDacTime
+        if not dac_time:
+            # Some host APIs leave the DAC time unset
+            dac_time = self.stream.time + self.stream.latency
+        dac_time -= self._clock_offset
+        skip = round((start_at - dac_time) * self.samplerate)
+        if skip >= frames:
+            outdata[:] = 0
+            return frames
+        skip = max(skip, 0)
+        outdata[:skip] = 0
+        self.start_at = None
+
+        # Times on the time.monotonic() clock
+        onset = dac_time + skip / self.samplerate
+        event = self._event('started')
+        event.update({
+            "onset_mono": onset,
+            "onset_wall": onset + time.time() - time.monotonic(),
+            "late_ms": (onset - start_at) * 1000,
+        })
+        _notify(event)
+        return skip
+
+
+    def _on_finished(self):
+        if self.finished.is_set():
+            return
+        close = getattr(self.source, 'close', None)
+        if close is not None:
+            close()
+        _active.discard(self)
+        if self.output is None:
+            _finished.append(self)
+        self.finished.set()
+        _notify(self._event('stopped' if self._stopped else 'finished'))
+
+
+    def start(self):
+        with self._start_lock:
+            if self.finished.is_set():
+                # Stopped before it was started
+                return
+            self._started = True
+        # Release streams of players that have ended
+        while _finished:
+            player = _finished.pop()
+            if not player.stream.closed:
+                player.stream.close(ignore_errors=True)
+        _active.add(self)
+        # Relate the stream clock to time.monotonic() for start_at
+        self._clock_offset = self.stream.time - time.monotonic()
+        start = time.perf_counter()
+        self._started_at = start
+        if self.output is not None:
+            self.output.play(self)
+        else:
+            self.stream.start()
+        latency.record("stream_open",
+            self._open_seconds + time.perf_counter() - start)
+
+
+    def stop(self):
+        """ Stop output immediately. A player on its own stream
+            releases the device; on a persistent stream it is
+            silenced from the next block. A player that has not
+            been started yet ends at once and will not start.
+        """
+        with self._start_lock:
+            if not self._started:
+                if not self.finished.is_set():
+                    self._stopped = True
+                    self.close()
+                    self._on_finished()
+                return
+        if self.output is not None:
+            if not self.finished.is_set():
+                self.output.stop(self)
+            return
+        if self.stream.closed:
+            return
+        self._stopped = True
+        self.stream.abort()
+        self.stream.close()
+
+
+    def close(self):
+        """ Release a player that was never started.
+        """
+        if self.output is None:
+            self.stream.close()
+
+
+class PCMSink:
+    """ Turn raw PCM bytes arriving from the network into blocks
+        for a JitterBuffer, starting playback once enough audio
+        has been buffered.
+
+        The buffer holds at most about max_buffer seconds: while
+        `full` is True the reader should stop reading the socket
+        and leave the sender to wait.
+    """
+
+    def __init__(self, samplerate, channels, sample_format='float32',
+        gain=1.0, device=None, prefill=0.1, max_buffer=4.0):
+        """ samplerate: frames per second of the incoming audio
+            channels: channels in the incoming audio
+            sample_format: a key of PCM_FORMATS
+            gain: linear gain applied to every sample
+            device: output device ID
+            prefill: seconds to buffer before starting playback
+            max_buffer: seconds buffered before `full` is set
+        """
+        try:
+            self.dtype, full_scale = PCM_FORMATS[sample_format]
+        except KeyError:
+            raise ValueError(
+                f"playback: Unsupported sample format '{sample_format}'.")
+        self.channels = channels
+        self.scale = gain / full_scale
+        self.frame_bytes = self.dtype.itemsize * channels
+        self.prefill_frames = int(prefill * samplerate)
+        self.frames_received = 0
+        self._leftover = b""
+
+        # Drop channels the device cannot play
+        outputs = sd.query_devices(device, 'output')['max_output_channels']
+        self.out_channels = min(channels, outputs)
+        if self.out_channels < channels:
+            print(f"playback: {channels}-channel stream, but only "
+                f"{outputs} audio device output channels!")
+
+        self.buffer = JitterBuffer(
+            self.out_channels, max_frames=int(max_buffer * samplerate))
+        self.player = StreamPlayer(
+            self.buffer, samplerate, self.out_channels, device=device)
+        self.started = False
+        # Set by stop(); the rest of the upload is then dropped
+        self.stopped = False
+
+
+    @property
+    def full(self):
+        """ True while the buffer is full and still being played.
+        """
+        return self.buffer.full and not self.stopped \
+            and not self.player.finished.is_set()
+
+
+    def feed(self, data):
+        """ Add received bytes. Partial frames are kept until the
+            rest arrives. Bytes arriving after playback has ended
+            (e.g. was stopped) are dropped.
+        """
+        if self.stopped or self.player.finished.is_set():
+            return
+        if self._leftover:
+            data = self._leftover + bytes(data)
+        usable = len(data) - len(data) % self.frame_bytes
+        self._leftover = bytes(data[usable:])
+        if not usable:
+            return
+
+        samples = np.frombuffer(
+            data, dtype=self.dtype, count=usable // self.dtype.itemsize)
+        block = samples.reshape(-1, self.channels)[:, :self.out_channels]
+        block = block.astype(np.float32)
+        block *= self.scale
+        self.buffer.write(block)
+        self.frames_received += len(block)
+
+        if not self.started and (self.buffer.frames >= self.prefill_frames
+            or self.buffer.full):
+            self._start()
+
+
+    def finish(self):
+        """ All bytes have arrived; play out what is buffered.
+        """
+        self.buffer.close()
+        if self.started or self.stopped:
+            return
+        if self.frames_received:
+            self._start()
+        else:
+            # Nothing to play
+            self.player.close()
+
+
+    def _start(self):
+        if self.stopped:
+            return
+        self.started = True
+        self.player.start()
+
+
+    def stop(self):
+        """ Stop playback, whether it has started or is still
+            prefilling, and drop whatever arrives afterwards.
+        """
+        self.stopped = True
+        self.buffer.close()
+        self.player.stop()
@@ -25,7 +25,12 @@ class SessionParsModel:
         #'raw_lvl': {'type': 'float', 'value': -20},
         #'SLM Reading': {'type': 'float', 'value': 70},
         #'Adjusted Presentation Level': {'type': 'float', 'value': -50},
-        'Calibration File': {'type': 'str', 'value': 'cal_stim.wav'}
+        'Calibration File': {'type': 'str', 'value': 'cal_stim.wav'},
+        'Server Engine': {'type': 'str', 'value': 'selectors'},
+        # Optional AF_UNIX socket path served alongside TCP ('' = off)
+        'Local Socket Path': {'type': 'str', 'value': ''},
+        # Further output devices requests can name: 'name=id, ...'
+        'Named Devices': {'type': 'str', 'value': ''},
     }
 
     def __init__(self):
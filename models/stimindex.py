@@ -0,0 +1,282 @@
+""" On-disk index of stimulus statistics.
+
+    build() walks a stimulus directory with a process pool and
+    stores, for every audio file, its sample rate, length and
+    per-channel mean (DC), minimum, maximum and RMS in a sidecar
+    file (INDEX_NAME) at the top of the directory. Entries are
+    checked against each file's size and modification time, so
+    rebuilding only rescans files that changed.
+
+    lookup() finds the index covering a file (the nearest
+    sidecar in its directory or above) and returns the file's
+    statistics without reading any audio, or None if the file
+    is not indexed or has changed since.
+"""
+
+###########
+# Imports #
+###########
+# Import data science packages
+import numpy as np
+
+# Import system packages
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# Import audio packages
+import soundfile as sf
+
+
+#########
+# BEGIN #
+#########
+INDEX_NAME = ".stimindex.json"
+
+# Bump when the entry layout changes; older indexes are rebuilt
+VERSION = 1
+
+# Files indexed by build()
+EXTENSIONS = ('.wav', '.flac', '.ogg', '.aif', '.aiff')
+
+# Frames read at a time while scanning
+BLOCK_FRAMES = 2**16
+
+# Entry layout: size, mtime_ns, samplerate, frames, then
+# per-channel lists
+_FIELDS = ('mean', 'min', 'max', 'rms')
+
+
+def scan_file(file_path):
+    """ Read a file block by block and return its index entry,
+        or None if it cannot be read. Runs in worker processes.
+    """
+    try:
+        st = os.stat(file_path)
+        with sf.SoundFile(file_path) as f:
+            channels = f.channels
+            total = np.zeros(channels)
+            squares = np.zeros(channels)
+            low = np.full(channels, np.inf)
+            high = np.full(channels, -np.inf)
+            frames = 0
+            for block in f.blocks(blocksize=BLOCK_FRAMES, dtype='float32',
+                always_2d=True):
+                total += block.sum(axis=0, dtype=np.float64)
+                squares += np.einsum('ij,ij->j', block, block,
+                    dtype=np.float64)
+                np.minimum(low, block.min(axis=0), out=low)
+                np.maximum(high, block.max(axis=0), out=high)
+                frames += len(block)
+            samplerate = f.samplerate
+    except (OSError, RuntimeError) as e:
+        print(f"stimindex: Cannot read {file_path}: {e}")
+        return None
+    if not frames:
+        low = high = np.zeros(channels)
+    count = max(frames, 1)
+    return [st.st_size, st.st_mtime_ns, samplerate, frames,
+        (total / count).tolist(), low.tolist(), high.tolist(),
+        np.sqrt(squares / count).tolist()]
+
+
+def entry_stats(entry):
+    """ Turn an index entry into a dict: 'samplerate', 'frames',
+        'duration', and per-channel arrays 'mean', 'min', 'max',
+        'rms' and 'peak' (largest absolute sample).
+    """
+    _, _, samplerate, frames = entry[:4]
+    stats = {
+        'samplerate': samplerate,
+        'frames': frames,
+        'duration': frames / samplerate,
+    }
+    for name, values in zip(_FIELDS, entry[4:]):
+        stats[name] = np.array(values)
+    stats['peak'] = np.maximum(stats['max'], -stats['min'])
+    return stats
+
+
+def file_stats(file_path):
+    """ Scan one file now and return its statistics (see
+        entry_stats()). Raises RuntimeError if it cannot be read.
+    """
+    entry = scan_file(file_path)
+    if entry is None:
+        raise RuntimeError(f"stimindex: Cannot read {file_path}")
+    return entry_stats(entry)
+
+
+class StimulusIndex:
+    """ Statistics of the audio files under one directory, kept
+        in its INDEX_NAME sidecar.
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.path = os.path.join(self.directory, INDEX_NAME)
+        # Relative path (with '/') -> entry
+        self.files = {}
+        # Sidecar modification time when loaded
+        self.mtime = None
+        self.load()
+
+
+    def _relpath(self, file_path):
+        rel = os.path.relpath(os.path.abspath(file_path), self.directory)
+        return rel.replace(os.sep, '/')
+
+
+    def load(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') == VERSION:
+            self.files = data.get('files', {})
+            self.mtime = mtime
+
+
+    def save(self):
+        """ Write the sidecar; readers see the old or the new
+            file, never a partial one.
+        """
+        temp = self.path + ".tmp"
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump({'version': VERSION, 'files': self.files}, f,
+                separators=(',', ':'))
+        os.replace(temp, self.path)
+        self.mtime = os.stat(self.path).st_mtime_ns
+
+
+    def get(self, file_path, st=None):
+        """ Statistics of a file (see entry_stats()), or None if it
+            is not indexed or has changed.
+        """
+        entry = self.files.get(self._relpath(file_path))
+        if entry is None:
+            return None
+        if st is None:
+            st = os.stat(file_path)
+        if entry[:2] != [st.st_size, st.st_mtime_ns]:
+            return None
+        return entry_stats(entry)
+
+
+    def update(self, workers=None):
+        """ Scan new and changed files under the directory, drop
+            entries for files that are gone, and save. Returns a
+            summary dict.
+
+            workers: processes to scan with (default: one per
+                CPU); 1 scans in this process
+        """
+        start = time.perf_counter()
+        files = {}
+        stale = []
+        for root, dirs, names in os.walk(self.directory):
+            dirs.sort()
+            for name in sorted(names):
+                if not name.lower().endswith(EXTENSIONS):
+                    continue
+                path = os.path.join(root, name)
+                rel = self._relpath(path)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entry = self.files.get(rel)
+                if entry is not None \
+                    and entry[:2] == [st.st_size, st.st_mtime_ns]:
+                    files[rel] = entry
+                else:
+                    stale.append((rel, path))
+
+        reused = len(files)
+        paths = [path for _, path in stale]
+        workers = workers or os.cpu_count() or 1
+        if workers == 1 or len(paths) < 2:
+            entries = [scan_file(path) for path in paths]
+        else:
+            # Spawn (as on Windows) rather than fork a process that
+            # may be running audio and server threads
+            with ProcessPoolExecutor(max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn')
+            ) as executor:
+                entries = list(executor.map(scan_file, paths,
+                    chunksize=max(1, len(paths) // (workers * 8))))
+
+        errors = 0
+        for (rel, _), entry in zip(stale, entries):
+            if entry is None:
+                errors += 1
+            else:
+                files[rel] = entry
+
+        removed = len(set(self.files) - set(files))
+        self.files = files
+        self.save()
+        return {
+            'directory': self.directory,
+            'files': len(files),
+            'scanned': len(stale) - errors,
+            'reused': reused,
+            'removed': removed,
+            'errors': errors,
+            'seconds': round(time.perf_counter() - start, 3),
+        }
+
+
+# Loaded indexes by directory
+_indexes = {}
+_lock = threading.Lock()
+
+
+def build(directory, workers=None):
+    """ Create or refresh the index of a directory. Returns the
+        summary from StimulusIndex.update().
+    """
+    index = StimulusIndex(directory)
+    summary = index.update(workers)
+    with _lock:
+        _indexes[index.directory] = index
+    return summary
+
+
+def find(file_path):
+    """ The index covering a file: the nearest sidecar in its
+        directory or above, reloaded if it has been rewritten.
+        None if there is none.
+    """
+    directory = os.path.dirname(os.path.abspath(file_path))
+    while True:
+        try:
+            mtime = os.stat(os.path.join(directory, INDEX_NAME)).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime is not None:
+            with _lock:
+                index = _indexes.get(directory)
+                if index is None or index.mtime != mtime:
+                    index = StimulusIndex(directory)
+                    _indexes[directory] = index
+            return index
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+
+def lookup(file_path):
+    """ Indexed statistics of a file (see entry_stats()), or None.
+    """
+    try:
+        index = find(file_path)
+        return index.get(file_path) if index is not None else None
+    except OSError:
+        return None
@@ -0,0 +1,141 @@
+""" Memory-mapped access to PCM WAV files.
+
+    open_memmap() parses the RIFF header and returns the sample
+    data as an np.memmap view of the file, so opening is fast
+    whatever the file length and pages are only read when the
+    samples are used. Formats numpy cannot map directly (24-bit,
+    compressed, ...) return None; read those with soundfile.
+"""
+
+###########
+# Imports #
+###########
+# Import data science packages
+import numpy as np
+
+# Import system packages
+import struct
+
+
+#########
+# BEGIN #
+#########
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# (format, bits per sample) -> (numpy dtype, full-scale value)
+_DTYPES = {
+    (WAVE_FORMAT_PCM, 8): (np.dtype('u1'), 128.0),
+    (WAVE_FORMAT_PCM, 16): (np.dtype('<i2'), 32768.0),
+    (WAVE_FORMAT_PCM, 32): (np.dtype('<i4'), 2147483648.0),
+    (WAVE_FORMAT_IEEE_FLOAT, 32): (np.dtype('<f4'), 1.0),
+    (WAVE_FORMAT_IEEE_FLOAT, 64): (np.dtype('<f8'), 1.0),
+}
+
+# Offset of unsigned 8-bit samples
+_OFFSETS = {np.dtype('u1'): 128.0}
+
+
+class MappedWav:
+    """ Sample data of a WAV file mapped into memory.
+
+        data: np.memmap of shape (frames, channels), raw samples
+        fs: sample rate
+        full_scale: divide by this (after subtracting offset) to
+            get floats in [-1, 1)
+        offset: zero level of the raw samples
+    """
+
+    def __init__(self, data, fs, full_scale, offset=0.0):
+        self.data = data
+        self.fs = fs
+        self.full_scale = full_scale
+        self.offset = offset
+
+
+def _chunks(f):
+    """ Yield (chunk id, size, data offset) for each RIFF chunk.
+    """
+    riff = f.read(12)
+    if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+        return
+    pos = 12
+    while True:
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        chunk_id, size = struct.unpack('<4sI', header)
+        yield chunk_id, size, pos + 8
+        # Chunks are padded to an even size
+        pos += 8 + size + (size & 1)
+
+
+def open_memmap(file_path):
+    """ Map a PCM or float WAV file. Returns a MappedWav, or None
+        if the file cannot be mapped.
+    """
+    fmt = None
+    with open(file_path, 'rb') as f:
+        file_size = f.seek(0, 2)
+        f.seek(0)
+        for chunk_id, size, offset in _chunks(f):
+            if chunk_id == b'fmt ':
+                f.seek(offset)
+                fmt = f.read(size)
+            elif chunk_id == b'data':
+                data_offset, data_size = offset, size
+                break
+        else:
+            return None
+    if fmt is None or len(fmt) < 16:
+        return None
+
+    tag, channels, fs, _, block_align, bits = struct.unpack('<HHIIHH', fmt[:16])
+    if tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+        # Sub-format GUID starts with the actual format tag
+        tag = struct.unpack('<H', fmt[24:26])[0]
+    try:
+        dtype, full_scale = _DTYPES[(tag, bits)]
+    except KeyError:
+        return None
+    if channels < 1 or block_align != dtype.itemsize * channels:
+        return None
+
+    # Some writers leave the data size unset or too large
+    data_size = min(data_size, file_size - data_offset)
+    frames = data_size // block_align
+    if frames == 0:
+        return None
+    data = np.memmap(file_path, dtype=dtype, mode='r', offset=data_offset,
+        shape=(frames, channels))
+    return MappedWav(data, fs, full_scale, _OFFSETS.get(dtype, 0.0))
+
+
+def channel_stats(mapped, chunk_frames=2**16):
+    """ Per-channel mean, minimum and maximum of the raw samples.
+
+        Reads the file in chunks through an ordinary file handle
+        rather than the map, so the scan does not leave the whole
+        file resident in this process.
+    """
+    data = mapped.data
+    frames, channels = data.shape
+    total = np.zeros(channels)
+    low = np.full(channels, np.inf)
+    high = np.full(channels, -np.inf)
+    with open(data.filename, 'rb') as f:
+        f.seek(data.offset)
+        remaining = frames
+        while remaining:
+            count = min(chunk_frames, remaining)
+            block = np.fromfile(f, dtype=data.dtype, count=count * channels)
+            block = block.reshape(-1, channels)
+            if not len(block):
+                break
+            total += block.sum(axis=0, dtype=np.float64)
+            np.minimum(low, block.min(axis=0), out=low)
+            np.maximum(high, block.max(axis=0), out=high)
+            remaining -= len(block)
+    return total / frames, low, high
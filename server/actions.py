@@ -0,0 +1,621 @@
+""" Request actions for Socket Audio Player.
+
+    The action set is shared by every server engine, so each
+    engine only has to deal with framing and connections.
+"""
+
+###########
+# Imports #
+###########
+# Import system packages
+import os
+import threading
+import time
+import traceback
+
+# Import custom modules
+from models import audiocache
+from models import audiomodel
+from models import latency
+from models import playback
+from models import stimindex
+from server import jobs
+from server import protocol
+
+
+#########
+# BEGIN #
+#########
+# Actions passed the time their request arrived
+RECEIVE_STAMPED = ('ping', 'timesync')
+
+
+class ActionHandler:
+    """ Carry out decoded JSON requests and build their
+        response content.
+
+        Requests may be handled on several threads at once: the
+        engine's action thread, the asyncio engine's control
+        thread (stopaudio, killserver) and the job workers. State
+        that more than one of them changes is guarded by a lock.
+    """
+
+    def __init__(self, server):
+        self.server = server
+
+        # Most recently played audio object
+        self.audio = None
+
+        # Current PCM upload on each device (see open_pcm_stream),
+        # also stopped from the control thread
+        self.pcm = {}
+        self._pcm_lock = threading.Lock()
+
+        # Work done after the response has been sent. Index and
+        # preload jobs run in their own lane, so playback jobs
+        # never wait behind them.
+        self.jobs = jobs.JobQueue()
+
+        # Map action names to handlers
+        self.actions = {
+            'playaudio': self._playaudio,
+            'stopaudio': self._stopaudio,
+            'killserver': self._killserver,
+            'hello': self._hello,
+            'batch': self._batch,
+            'jobstatus': self._jobstatus,
+            'subscribe': self._subscribe,
+            'unsubscribe': self._unsubscribe,
+            'stats': self._stats,
+            'resetstats': self._resetstats,
+            'ping': self._timesync,
+            'timesync': self._timesync,
+            'playat': self._playat,
+            'devices': self._devices,
+            'preload': self._preload,
+            'unload': self._unload,
+            'evict': self._unload,
+            'index': self._index,
+            'stimstats': self._stimstats,
+        }
+
+
+    def handle(self, request, received=None):
+        """ Run a request and return the response content dict.
+
+            received: (time.monotonic(), time.time()) when the
+                request body was read, for RECEIVE_STAMPED actions;
+                None to use the time the action runs
+        """
+        if not isinstance(request, dict):
+            return {"result": "libserver: Error: request must be a JSON "
+                "object.", "error": True}
+        action = request.get("action")
+        try:
+            handler = self.actions[action]
+        except (KeyError, TypeError):
+            return {"result": f"libserver: Error: invalid action '{action}'.",
+                "error": True}
+        start = time.perf_counter()
+        try:
+            if action in RECEIVE_STAMPED:
+                return handler(request.get("value"), received)
+            return handler(request.get("value"))
+        except Exception as e:
+            # Answer with an error so the connection, and any
+            # requests pipelined behind this one, carry on
+            print(f"libserver: Error: action '{action}' failed:\n"
+                f"{traceback.format_exc()}")
+            return {"result": f"libserver: Error: {e!r}", "error": True}
+        finally:
+            latency.record("action", time.perf_counter() - start)
+
+
+    def open(self):
+        """ Pass playback events on to subscribed clients while
+            the server runs.
+        """
+        playback.add_listener(self._on_playback_event)
+
+
+    def close(self):
+        """ Stop playback, release the devices' persistent streams
+            and stop listening for playback events. Loaded audio
+            and jobs are kept for the next run.
+        """
+        # Still listening, so jobs playing now are marked done
+        playback.stop_all()
+        playback.close_streams()
+        playback.remove_listener(self._on_playback_event)
+
+
+    def _on_playback_event(self, event):
+        """ Called by models.playback (from the audio thread) when
+            a stream finishes, is stopped or underruns.
+        """
+        ended = event["event"] in ('finished', 'stopped')
+        job = self.jobs.get(event.get("job"))
+        if job is not None and ended:
+            job.frames = event["frames"]
+            job.set_state(jobs.DONE)
+        if ended:
+            self.server.post_event(
+                'playback_stopped', frames=event["frames"])
+        self.server.notify(event)
+
+
+    def handle_binary(self, data):
+        """ Response for binary or unknown content types.
+        """
+        return {
+            "content_bytes": b"First 10 bytes of request: " + data[:10],
+            "content_type": "binary/custom-server-binary-type",
+            "content_encoding": "binary",
+        }
+
+
+    def open_pcm_stream(self, jsonheader):
+        """ Begin playing a raw PCM upload described by the JSON
+            header. Returns a PCMSink to feed the body into.
+        """
+        for reqhdr in protocol.PCM_HEADERS:
+            if reqhdr not in jsonheader:
+                raise ValueError(
+                    f"libserver: Missing required PCM header '{reqhdr}'.")
+        level = jsonheader.get("level")
+        name = jsonheader.get("device") or protocol.DEFAULT_DEVICE
+        device = self.server.resolve_device(name)
+        sink = playback.PCMSink(
+            samplerate=jsonheader["sample-rate"],
+            channels=jsonheader["channels"],
+            sample_format=jsonheader.get("sample-format", "float32"),
+            gain=1.0 if level is None else audiomodel.Audio.db2mag(level),
+            device=device,
+            prefill=jsonheader.get("prefill", 0.1),
+        )
+        sink.player.info.update({"filepath": "PCM stream", "device": name})
+        # Only one upload plays at a time on each device
+        with self._pcm_lock:
+            old = self.pcm.pop(name, None)
+            self.pcm[name] = sink
+        if old is not None:
+            old.stop()
+        self.server.post_event(
+            'playback_started', filepath="PCM stream", level=level)
+        return sink
+
+
+    def close_pcm_stream(self, sink):
+        """ The whole body has been fed; let the sink play out.
+            Returns the response content.
+        """
+        sink.finish()
+        return {
+            "result": f"Received {sink.frames_received} frames",
+            "frames": sink.frames_received,
+            "underruns": sink.buffer.underruns,
+        }
+
+
+    def _stop_pcm(self, name=None):
+        """ Stop the PCM upload on the named device, or on all
+            devices.
+        """
+        with self._pcm_lock:
+            names = list(self.pcm) if name is None else [name]
+            sinks = [self.pcm.pop(name, None) for name in names]
+        for sink in sinks:
+            if sink is not None:
+                sink.stop()
+
+
+    def _device(self, value):
+        """ Name and ID of the device a request's value names.
+            Raises ValueError for unknown names.
+        """
+        name = None
+        if isinstance(value, dict):
+            name = value.get("device")
+        name = name or protocol.DEFAULT_DEVICE
+        return name, self.server.resolve_device(name)
+
+
+    ###########
+    # Actions #
+    ###########
+    def _playaudio(self, audio_dict):
+        try:
+            self._device(audio_dict)
+        except ValueError as e:
+            return {"result": f"libserver: Error: {e}", "error": True}
+
+        if audio_dict.get('async'):
+            # Reply now; load and play on the job thread
+            job = self.jobs.submit('playaudio', self._play_job, audio_dict)
+            return {"result": f"Queued job {job.id}", "job": job.id}
+
+        answer = f"\nFound file: {audio_dict.get('filepath')}\n" \
+            f"Found level: {audio_dict.get('level')}"
+        self._load_and_play(audio_dict)
+        return self._level_note({"result": answer})
+
+
+    def _playat(self, audio_dict):
+        """ Load a file and start it at a given server time: 'at'
+            (time.time()) or 'at_mono' (time.monotonic()). The
+            reply comes once the stream is primed; subscribers get
+            a 'started' event with the actual onset.
+        """
+        if 'at_mono' in audio_dict:
+            start_at = float(audio_dict['at_mono'])
+        elif 'at' in audio_dict:
+            start_at = float(audio_dict['at']) - time.time() + time.monotonic()
+        else:
+            return {"result": "libserver: Error: playat needs 'at' or "
+                "'at_mono'.", "error": True}
+        try:
+            self._device(audio_dict)
+        except ValueError as e:
+            return {"result": f"libserver: Error: {e}", "error": True}
+
+        if audio_dict.get('async'):
+            job = self.jobs.submit(
+                'playat', self._play_job, audio_dict, start_at)
+            return {"result": f"Queued job {job.id}", "job": job.id,
+                "at_mono": start_at}
+
+        self._load_and_play(audio_dict, start_at=start_at)
+        lead = start_at - time.monotonic()
+        return self._level_note({
+            "result": f"Scheduled {audio_dict.get('filepath')} in "
+                f"{lead * 1000:.1f} ms",
+            "at_mono": start_at,
+            "lead_ms": lead * 1000,
+        })
+
+
+    def _level_note(self, content):
+        """ Say in a playback response if the level could not be
+            checked for clipping before playing.
+        """
+        if not self.audio.level_checked:
+            content["result"] += "\nLevel not checked for clipping; " \
+                "clipped samples are counted in playback events"
+            content["level_checked"] = False
+        return content
+
+
+    def _load_and_play(self, audio_dict, job=None, start_at=None):
+        """ Load and present a file, updating job (if given) as
+            it goes. start_at: see Audio.play().
+        """
+        if job:
+            job.set_state(jobs.LOADING)
+        name, device = self._device(audio_dict)
+        audio = audiomodel.Audio(
+            file_path=audio_dict.get('filepath'),
+            interactive=False,
+            stream=audio_dict.get('stream'))
+        info = {"filepath": audio_dict.get('filepath'), "device": name}
+        if job:
+            info["job"] = job.id
+        # Raises if the stream cannot be opened; jobs then fail
+        audio.play(
+            level=audio_dict.get('level'),
+            device_id=device,
+            info=info,
+            start_at=start_at)
+        if job and not audio.level_checked:
+            job.details["level_checked"] = False
+        # A short stimulus may already have finished
+        if job and job.state == jobs.LOADING:
+            job.set_state(jobs.PLAYING)
+        self.audio = audio
+        self.server.post_event(
+            'playback_started',
+            filepath=audio_dict.get('filepath'),
+            level=audio_dict.get('level'))
+
+
+    def _play_job(self, job, audio_dict, start_at=None):
+        self._load_and_play(audio_dict, job, start_at)
+
+
+    def _preload(self, value):
+        """ Decode files into the audio cache ahead of playback.
+            Value is a list of paths, or a dict with 'files' and
+            optionally 'wait'. Loading runs on the job thread and
+            the results appear in the job's status; with 'wait'
+            they are returned directly.
+        """
+        wait = False
+        if isinstance(value, dict):
+            wait = value.get("wait", False)
+            value = value.get("files")
+        if isinstance(value, str):
+            value = [value]
+        if not isinstance(value, list) or not value:
+            return {"result": "libserver: Error: preload needs a list of "
+                "files.", "error": True}
+
+        if wait:
+            content = {"result": f"Preloaded {len(value)} files"}
+            content.update(self._preload_files(value))
+            return content
+        job = self.jobs.submit('preload', self._preload_job, value,
+            lane=jobs.BACKGROUND)
+        return {"result": f"Queued job {job.id}", "job": job.id}
+
+
+    def _preload_job(self, job, paths):
+        job.set_state(jobs.LOADING)
+        job.details = self._preload_files(paths)
+
+
+    def _preload_files(self, paths):
+        """ Load each file into the cache. Returns per-file load
+            times and the bytes resident afterwards.
+        """
+        files = []
+        for path in paths:
+            entry = {"filepath": path}
+            cached = audiocache.cache.contains(path)
+            start = time.perf_counter()
+            try:
+                signal, _ = audiocache.cache.read(path)
+            except Exception as e:
+                entry["error"] = repr(e)
+            else:
+                entry["load_ms"] = (time.perf_counter() - start) * 1000
+                entry["bytes"] = signal.nbytes
+                entry["cached"] = cached
+            files.append(entry)
+        # Files may not all fit within the cache budget
+        for entry in files:
+            entry["resident"] = audiocache.cache.contains(entry["filepath"])
+        return {"files": files, "cache_bytes": audiocache.cache.bytes}
+
+
+    def _unload(self, value):
+        """ Drop files from the audio cache. Value is a path, a
+            list of paths, or None for every file.
+        """
+        if isinstance(value, dict):
+            value = value.get("files")
+        if value is None:
+            freed = audiocache.cache.evict()
+        else:
+            if isinstance(value, str):
+                value = [value]
+            freed = sum(audiocache.cache.evict(path) for path in value)
+        return {"result": f"Freed {freed} bytes", "freed_bytes": freed,
+            "cache_bytes": audiocache.cache.bytes}
+
+
+    def _index(self, value):
+        """ Build or refresh the statistics index of a stimulus
+            directory (see models.stimindex). Value is the
+            directory, or a dict with 'directory' and optionally
+            'workers' and 'wait'. Runs on the job thread unless
+            'wait' is set.
+        """
+        workers = None
+        wait = False
+        if isinstance(value, dict):
+            workers = value.get("workers")
+            wait = value.get("wait", False)
+            value = value.get("directory")
+        if not isinstance(value, str) or not value:
+            return {"result": "libserver: Error: index needs a "
+                "directory.", "error": True}
+        if not os.path.isdir(value):
+            return {"result": f"libserver: Error: {value} is not a "
+                "directory.", "error": True}
+
+        if wait:
+            summary = stimindex.build(value, workers)
+            content = {"result": f"Indexed {summary['files']} files"}
+            content.update(summary)
+            return content
+        job = self.jobs.submit('index', self._index_job, value, workers,
+            lane=jobs.BACKGROUND)
+        return {"result": f"Queued job {job.id}", "job": job.id}
+
+
+    def _index_job(self, job, directory, workers):
+        job.set_state(jobs.LOADING)
+        job.details = stimindex.build(directory, workers)
+
+
+    def _stimstats(self, value):
+        """ Statistics of stimulus files: from their index when
+            it is up to date, otherwise read now. Value is a path
+            or a list of paths.
+        """
+        if isinstance(value, dict):
+            value = value.get("files")
+        if isinstance(value, str):
+            value = [value]
+        if not isinstance(value, list) or not value:
+            return {"result": "libserver: Error: stimstats needs a list "
+                "of files.", "error": True}
+
+        files = []
+        for path in value:
+            entry = {"filepath": path}
+            try:
+                stats = stimindex.lookup(path)
+                entry["indexed"] = stats is not None
+                if stats is None:
+                    stats = stimindex.file_stats(path)
+            except Exception as e:
+                entry["error"] = repr(e)
+            else:
+                entry.update({
+                    "samplerate": stats["samplerate"],
+                    "frames": stats["frames"],
+                    "duration": stats["duration"],
+                    "channels": len(stats["mean"]),
+                    "peak": stats["peak"].tolist(),
+                    "rms": stats["rms"].tolist(),
+                    "dc": stats["mean"].tolist(),
+                })
+            files.append(entry)
+        return {"result": f"Statistics of {len(files)} files",
+            "files": files}
+
+
+    def _stopaudio(self, value):
+        """ Stop playback on the device named by 'device' in the
+            value, or on every device.
+        """
+        if isinstance(value, dict) and value.get("device"):
+            try:
+                name, device = self._device(value)
+            except ValueError as e:
+                return {"result": f"libserver: Error: {e}", "error": True}
+            playback.stop_all(device=device)
+            self._stop_pcm(name)
+            return {"result": f"Stopping audio playback on {name}"}
+        playback.stop_all()
+        self._stop_pcm()
+        return {"result": "Stopping audio playback"}
+
+
+    def _devices(self, _):
+        """ List the output devices requests can name.
+        """
+        devices = {protocol.DEFAULT_DEVICE: self.server.audio_device}
+        devices.update(self.server.devices)
+        return {"result": f"{len(devices)} devices", "devices": devices}
+
+
+    def _killserver(self, _):
+        self.server.stop()
+        print("libserver: Server killed!")
+        return {"result": "Killing server"}
+
+
+    def _hello(self, value):
+        """ Agree a protocol version. The connection switches to
+            it once this response has been sent.
+        """
+        offered = (value or {}).get("versions", [1])
+        version = protocol.negotiate(offered)
+        return {
+            "result": f"Using protocol version {version}",
+            "version": version,
+        }
+
+
+    def _batch(self, value):
+        """ Run a list of requests in order and answer them all
+            at once. Value is a list of requests, or a dict with
+            'actions' (the list) and 'stop_on_error' (default
+            True: skip the rest after a failure).
+        """
+        if isinstance(value, dict):
+            requests = value.get("actions", [])
+            stop_on_error = value.get("stop_on_error", True)
+        else:
+            requests = value or []
+            stop_on_error = True
+
+        results = []
+        failed = False
+        for request in requests:
+            if failed and stop_on_error:
+                results.append({"result": "Skipped", "skipped": True})
+                continue
+            try:
+                result = self.handle(request)
+            except Exception as e:
+                print(f"libserver: Error: batch action failed: {e!r}")
+                result = {"result": f"libserver: Error: {e!r}", "error": True}
+            # Actions also fail by returning an error result
+            if result.get("error"):
+                failed = True
+            results.append(result)
+        return {
+            "result": f"Ran {len(requests)} actions",
+            "results": results,
+        }
+
+
+    def _jobstatus(self, value):
+        """ Report on queued jobs. Value is a job ID, a list of
+            IDs, a dict with 'job', or None for all known jobs.
+        """
+        if isinstance(value, dict):
+            value = value.get("job")
+        if value is None:
+            job_ids = list(self.jobs.jobs)
+        elif isinstance(value, list):
+            job_ids = value
+        else:
+            job_ids = [value]
+
+        statuses = []
+        for job_id in job_ids:
+            job = self.jobs.get(job_id)
+            if job is None:
+                statuses.append({"job": job_id, "state": "unknown"})
+            else:
+                statuses.append(job.status())
+        return {"result": f"{len(statuses)} jobs", "jobs": statuses}
+
+
+    def _stats(self, _):
+        """ Report latency percentiles for each stage of the
+            request path (see models.latency), and decoded-audio
+            cache counters.
+        """
+        stages = latency.snapshot()
+        return {"result": f"{len(stages)} stages", "stages": stages,
+            "cache": audiocache.cache.stats()}
+
+
+    def _resetstats(self, _):
+        """ Clear the latency histograms.
+        """
+        latency.reset()
+        audiocache.cache.reset_stats()
+        return {"result": "Statistics reset"}
+
+
+    def _timesync(self, value, received=None):
+        """ Report the server's monotonic and wall-clock times on
+            receiving the request and on sending the reply, for
+            clients estimating clock offset and round-trip time.
+            A 'client' field in the value is echoed back.
+
+            received: see handle(); the engines stamp it when the
+                body is read, so time spent waiting for this
+                handler to run is not mistaken for network delay
+        """
+        if received is None:
+            received = (time.monotonic(), time.time())
+        recv_mono, recv_wall = received
+        content = {
+            "result": "timesync",
+            "recv_mono": recv_mono,
+            "recv_wall": recv_wall,
+        }
+        if isinstance(value, dict) and "client" in value:
+            content["client"] = value["client"]
+        content["send_mono"] = time.monotonic()
+        content["send_wall"] = time.time()
+        return content
+
+
+    def _subscribe(self, _):
+        """ Ask for playback events on this connection. The
+            connection is registered once this response is sent.
+        """
+        return {"result": "Subscribed to playback events",
+            "subscribed": True}
+
+
+    def _unsubscribe(self, _):
+        return {"result": "Unsubscribed from playback events",
+            "subscribed": False}
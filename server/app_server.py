@@ -5,39 +5,94 @@
 # Imports #
 ###########
 # Import server packages
+import os
 import socket
 import selectors
+import stat
 import traceback
 
-# Import GUI packages
-import tkinter as tk
-from tkinter import messagebox
-
 # Import system packages
-import sys
+import queue
+import threading
+import time
 
 # Import custom modules
 #import server.libserver as libserver
+from models import audiocache
+from models import latency
+from models import playback
 from server import libserver
+from server import actions
+from server import protocol
+
+
+# Seconds restart() waits for the old listening thread
+RESTART_TIMEOUT = 5.0
+
+# Seconds between checks on PCM uploads waiting for the player
+PCM_POLL_SECONDS = 0.01
+
+# Selector data marking the wake-up socket
+_WAKE = "wake"
+
+# Default limits
+MAX_CONNECTIONS = 32
+MAX_MESSAGE_BYTES = 64 * 2**20
+MAX_BUFFERED_BYTES = 256 * 2**20
+
+
+def parse_devices(text):
+    """ Parse named devices written as 'name=id, name=id' into a
+        dict of device IDs.
+    """
+    devices = {}
+    for item in text.split(","):
+        if not item.strip():
+            continue
+        name, sep, device_id = item.partition("=")
+        if not sep or not name.strip():
+            raise ValueError(f"appserver: Invalid device entry '{item.strip()}'")
+        devices[name.strip()] = int(device_id)
+    return devices
 
 
 class Server:
+    """ Socket server for audio playback commands.
 
-    # Find parent window and tell it to 
-    # generate a callback sequence
-    def _event(self, sequence):
-        def callback(*_):
-            root = self.master.winfo_toplevel()
-            root.event_generate(sequence)
-        return callback
-    
+        The selector loop runs on its own thread (see start()).
+        Server events are placed on self.events as (kind, info)
+        tuples for the GUI to poll; the server never touches Tk.
+    """
 
-    def __init__(self, audio_device, host=None, port=None, **kwargs):
+    def __init__(self, audio_device, host=None, port=None, keep_alive=True,
+        read_size=libserver.READ_SIZE, unix_path=None,
+        max_connections=MAX_CONNECTIONS,
+        max_message_bytes=MAX_MESSAGE_BYTES,
+        max_buffered_bytes=MAX_BUFFERED_BYTES, devices=None,
+        cache_bytes=None, persistent_streams=None, blocksize=None,
+        output_latency=None, preroll=None, **kwargs):
         #super().__init__(parent, **kwargs)
 
         # Initialize values
         self.audio_device = audio_device
 
+        # Further output devices by name; requests pick one with
+        # 'device'
+        self.devices = dict(devices or {})
+
+        # Memory budget of the process-wide decoded-audio cache
+        if cache_bytes is not None:
+            audiocache.cache.resize(cache_bytes)
+
+        # Output streams: one persistent stream per device (the
+        # default) or one per stimulus, and their block size,
+        # suggested latency and silent pre-roll (see
+        # models.playback.configure)
+        stream_settings = (persistent_streams, blocksize, output_latency,
+            preroll)
+        if any(value is not None for value in stream_settings):
+            playback.configure(*stream_settings)
+
         # Assign host
         if not host:
             self.host = "127.0.0.1"
@@ -50,54 +105,360 @@ class Server:
         else:
             self.port = port
 
+        # Optional local (AF_UNIX) socket path, served alongside TCP
+        self.unix_path = unix_path or None
+
+        # Allow clients to send many requests over one connection
+        self.keep_alive = keep_alive
+
+        # Bytes asked of each socket read
+        self.read_size = read_size
+
+        # Limits: open connections, size of one buffered request
+        # body, and all buffered request bodies together
+        self.max_connections = max_connections
+        self.max_message_bytes = max_message_bytes
+        self.max_buffered_bytes = max_buffered_bytes
+
+        # Rotates the order ready connections are serviced in
+        self._turn = 0
+
+        # Request handling shared by all server engines. Kept
+        # across restarts, along with anything it has loaded.
+        self.actions = actions.ActionHandler(self)
+
+        # Queue of events for the GUI
+        self.events = queue.Queue()
+
+        # Listening thread
+        self.thread = None
+
+        # Selector for the current run (created by _listen)
+        self.sel = None
+
+        # Socket pair used to wake the selector from other threads
+        # (created by _listen)
+        self._wake_r = None
+        self._wake_w = None
+
+        self._reset_run_state()
+
+
+    def _reset_run_state(self):
+        """ State belonging to a single run of the listening
+            thread.
+        """
         # While loop control for server listening
         self.listening = 1
 
-        # Create selector
-        self.sel = selectors.DefaultSelector()
+        # Open connections, and bytes of request bodies buffered
+        self.connections = set()
+        self.buffered_bytes = 0
+
+        # Connections subscribed to playback events, and events
+        # waiting to be pushed to them
+        self.subscribers = set()
+        self._pushes = queue.Queue()
+
+        # PCM uploads not being read until their player has room
+        self.paused = set()
+
+
+    def post_event(self, kind, **info):
+        """ Queue a server event for the GUI. Safe to call from
+            any thread.
+        """
+        info['time'] = time.time()
+        self.events.put((kind, info))
 
-        # Start listening
-        self._listen()
+
+    def resolve_device(self, name=None):
+        """ Device ID for a device name from a request. None or
+            protocol.DEFAULT_DEVICE gives the main audio device.
+        """
+        if name is None or name == protocol.DEFAULT_DEVICE:
+            return self.audio_device
+        try:
+            return self.devices[name]
+        except (KeyError, TypeError):
+            raise ValueError(f"Unknown audio device '{name}'.")
+
+
+    def reserve(self, nbytes):
+        """ Account for a request body about to be buffered.
+            Returns an error message if that would break a limit,
+            otherwise None.
+        """
+        if nbytes > self.max_message_bytes:
+            return (f"message of {nbytes} bytes exceeds the "
+                f"{self.max_message_bytes}-byte limit")
+        if self.buffered_bytes + nbytes > self.max_buffered_bytes:
+            return "server buffers are full, try again later"
+        self.buffered_bytes += nbytes
+        return None
+
+
+    def release(self, nbytes):
+        """ A reserved request body is no longer buffered.
+        """
+        self.buffered_bytes -= nbytes
+
+
+    def notify(self, event):
+        """ Push an event to subscribed clients. Safe to call from
+            any thread.
+        """
+        self._pushes.put(event)
+        self._wake()
+
+
+    def _wake(self):
+        """ Interrupt a blocking select().
+        """
+        wake_w = self._wake_w
+        if wake_w is None:
+            return
+        try:
+            wake_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            # Already pending, or the server has stopped
+            pass
+
+
+    def _on_wake(self):
+        """ Runs on the server thread after a wake-up.
+        """
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                event = self._pushes.get_nowait()
+            except queue.Empty:
+                break
+            for message in list(self.subscribers):
+                message.push(event)
+
+
+    def start(self):
+        """ Begin listening on a background thread.
+        """
+        self.thread = threading.Thread(
+            target=self._listen, name="appserver", daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        """ Ask the listening thread to finish. Takes effect at
+            once, even while select() is waiting.
+        """
+        self.listening = 0
+        self._wake()
+
+
+    def restart(self, host=None, port=None, audio_device=None,
+        unix_path=None, devices=None):
+        """ Stop the server if it is running, then start it again
+            in this process. Settings given here replace the old
+            ones; the rest are kept, as is everything the action
+            handler has loaded. Call from any thread but the
+            server's own.
+        """
+        if self.is_running():
+            self.stop()
+            self.thread.join(RESTART_TIMEOUT)
+            if self.thread.is_alive():
+                raise RuntimeError(
+                    "appserver: Server did not stop in time for restart")
+        if host is not None:
+            self.host = host
+        if port is not None:
+            self.port = port
+        if audio_device is not None:
+            self.audio_device = audio_device
+        if devices is not None:
+            self.devices = dict(devices)
+        if unix_path is not None:
+            self.unix_path = unix_path or None
+        self._reset_run_state()
+        print("\nappserver: Restarting server")
+        self.start()
+
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+
+    def _is_unix_socket(self):
+        """ True if a socket file exists at unix_path, False if
+            nothing does. Raises OSError for any other file, which
+            is never removed.
+        """
+        try:
+            mode = os.stat(self.unix_path).st_mode
+        except FileNotFoundError:
+            return False
+        if not stat.S_ISSOCK(mode):
+            raise OSError(f"{self.unix_path} exists and is not a socket")
+        return True
+
+
+    def _open_unix_listener(self):
+        """ Bind the local socket, replacing a stale socket file.
+        """
+        if not hasattr(socket, 'AF_UNIX'):
+            raise OSError("Local sockets are not supported on this system")
+        if self._is_unix_socket():
+            os.unlink(self.unix_path)
+        usock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            usock.bind(self.unix_path)
+        except OSError:
+            usock.close()
+            raise
+        return usock
+
+
+    def _remove_unix_path(self):
+        if not self.unix_path:
+            return
+        try:
+            if self._is_unix_socket():
+                os.unlink(self.unix_path)
+        except OSError as e:
+            print(f"appserver: Error: Could not remove {self.unix_path}: {e}")
 
 
     def _listen(self):
+        self.sel = selectors.DefaultSelector()
+        self.actions.open()
         lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # Avoid bind() exception: OSError: [Errno 48] Address already in use
         lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        lsock.bind((self.host, self.port))
-        lsock.listen()
+        try:
+            lsock.bind((self.host, self.port))
+            listeners = [lsock]
+            if self.unix_path:
+                listeners.append(self._open_unix_listener())
+        except OSError as e:
+            lsock.close()
+            self.sel.close()
+            self.actions.close()
+            self.post_event('error', message=f"Could not bind: {e}")
+            self.post_event('stopped')
+            return
+        for sock in listeners:
+            sock.listen()
+            sock.setblocking(False)
+            self.sel.register(sock, selectors.EVENT_READ, data=None)
         print(f"\nappserver: Listening on {(self.host, self.port)}")
-        lsock.setblocking(False)
-        self.sel.register(lsock, selectors.EVENT_READ, data=None)
+        if self.unix_path:
+            print(f"appserver: Listening on {self.unix_path}")
+        wake_r, wake_w = socket.socketpair()
+        wake_r.setblocking(False)
+        wake_w.setblocking(False)
+        self.sel.register(wake_r, selectors.EVENT_READ, data=_WAKE)
+        self._wake_r, self._wake_w = wake_r, wake_w
+        self.post_event('listening', host=self.host, port=self.port,
+            unix_path=self.unix_path)
 
         try:
             while self.listening == 1:
-                events = self.sel.select(timeout=None)
-                for key, mask in events:
-                    if key.data is None:
-                        self.accept_wrapper(key.fileobj)
-                    else:
-                        message = key.data
-                        try:
-                            message.process_events(mask)
-                        except Exception:
-                            print(
-                                f"appserver: Error: Exception for {message.addr}:\n"
-                                f"{traceback.format_exc()}"
-                            )
-                            message.close()
+                # stop() wakes the selector, so a timeout is only
+                # needed to check on paused PCM uploads
+                events = self.sel.select(
+                    timeout=PCM_POLL_SECONDS if self.paused else None)
+                self._service(events)
+                for message in list(self.paused):
+                    message.resume_pcm()
         except KeyboardInterrupt:
             print("appserver: Caught keyboard interrupt, exiting")
         finally:
+            # Close any open connections along with the selector
+            for message in list(self.paused):
+                message.close()
+            for key in list(self.sel.get_map().values()):
+                if key.data is _WAKE:
+                    continue
+                elif key.data is not None:
+                    key.data.close()
+                else:
+                    key.fileobj.close()
             self.sel.close()
-            sys.exit()
+            self._wake_w = None
+            wake_r.close()
+            wake_w.close()
+            self._remove_unix_path()
+            self.actions.close()
+            print("appserver: Server stopped")
+            self.post_event('stopped')
+
+
+    def _service(self, events):
+        """ Handle one round of selector events.
+
+            Ready connections are serviced in turn, starting one
+            further along each round, with one read each. Pending
+            responses are then written, control actions (such as
+            stopaudio) first.
+        """
+        if events:
+            start = self._turn % len(events)
+            events = events[start:] + events[:start]
+            self._turn += 1
+
+        for key, mask in events:
+            if key.data is None:
+                self.accept_wrapper(key.fileobj)
+            elif key.data is _WAKE:
+                self._on_wake()
+            elif mask & selectors.EVENT_READ:
+                self._process(key.data, selectors.EVENT_READ)
+
+        writers = [
+            key.data for key, mask in events
+            if isinstance(key.data, libserver.Message)
+            and key.data.sock is not None
+            and (mask & selectors.EVENT_WRITE or key.data.has_request())
+        ]
+        writers.sort(key=lambda message: not message.is_control())
+        for message in writers:
+            if message.sock is not None:
+                self._process(message, selectors.EVENT_WRITE)
+
+
+    def _process(self, message, mask):
+        try:
+            message.process_events(mask)
+        except Exception as e:
+            print(
+                f"appserver: Error: Exception for {message.addr}:\n"
+                f"{traceback.format_exc()}"
+            )
+            # One client's failure is not a server error; the GUI
+            # only notes it in the status line
+            self.post_event('connection_error', addr=message.addr,
+                message=str(e).strip())
+            message.close()
 
 
     def accept_wrapper(self, sock):
+        start = time.perf_counter()
         conn, addr = sock.accept()  # Should be ready to read
+        if sock.family != socket.AF_INET:
+            # Local sockets have no peer address
+            addr = self.unix_path
         print('\n\nappserver: *** Begin Server Event ***')
         print(f"appserver: Accepted connection from {addr}")
         conn.setblocking(False)
         message = libserver.Message(self, self.sel, conn, addr, self.audio_device)
         #self._event(message.event_to_send)
         self.sel.register(conn, selectors.EVENT_READ, data=message)
+        if len(self.connections) >= self.max_connections:
+            message.reject(
+                f"too many connections (limit {self.max_connections})")
+        else:
+            self.connections.add(message)
+        latency.record("accept", time.perf_counter() - start)
@@ -0,0 +1,390 @@
+""" asyncio server engine for Socket Audio Player.
+
+    Alternative to the selectors loop in app_server.py. Speaks
+    the same framing and action set; selected at startup with
+    the 'Server Engine' session parameter.
+"""
+
+###########
+# Imports #
+###########
+# Import server packages
+import asyncio
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# Import system packages
+import time
+
+# Import custom modules
+from models import latency
+from server import app_server
+from server import libserver
+from server import protocol
+
+
+#########
+# BEGIN #
+#########
+class _Connection:
+    """ Per-connection state for the asyncio engine.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        # Local sockets have no peer address
+        self.addr = writer.get_extra_info('peername') or \
+            writer.get_extra_info('sockname')
+        self.task = asyncio.current_task()
+        # True while a request is being handled
+        self.busy = False
+        # Framing version; changed by a 'hello' request
+        self.version = 1
+        # Changes to apply once the current response is sent
+        self.next_version = None
+        self.subscription = None
+
+
+    def send(self, response, keep_alive=True):
+        """ Frame and queue a message in this connection's
+            protocol version.
+        """
+        if self.version == 2:
+            self.writer.write(protocol.create_message_v2(
+                **response, keep_alive=keep_alive))
+        else:
+            self.writer.write(protocol.create_message(
+                **response, keep_alive=keep_alive))
+
+
+    def push(self, event):
+        """ Send an event to a subscribed client.
+        """
+        if not self.writer.is_closing():
+            self.send(protocol.json_response(event))
+
+
+class AsyncServer(app_server.Server):
+    """ Socket server built on asyncio streams.
+
+        Each connection is a coroutine reading whole messages
+        with StreamReader.readexactly(). Actions run one at a
+        time on a worker thread so file loading never blocks
+        the event loop.
+    """
+
+    def __init__(self, audio_device, host=None, port=None, keep_alive=True,
+        read_size=libserver.READ_SIZE, **kwargs):
+        super().__init__(audio_device, host=host, port=port,
+            keep_alive=keep_alive, read_size=read_size, **kwargs)
+
+        # Set while serving
+        self._loop = None
+        self._stop_event = None
+
+        # Actions run one at a time on the action thread, except
+        # control actions (stopaudio, killserver), which get their
+        # own thread so they are not queued behind a slow load.
+        # ActionHandler locks the state both threads change.
+        self._executor = None
+        self._control_executor = None
+
+
+    def stop(self):
+        """ Ask the event loop to finish. Safe to call from any
+            thread.
+        """
+        self.listening = 0
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            try:
+                loop.call_soon_threadsafe(self._stop_event.set)
+            except RuntimeError:
+                # Loop closed in the meantime
+                pass
+
+
+    def notify(self, event):
+        """ Push an event to subscribed clients. Safe to call from
+            any thread.
+        """
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            try:
+                loop.call_soon_threadsafe(self._push, event)
+            except RuntimeError:
+                # Loop closed in the meantime
+                pass
+
+
+    def _push(self, event):
+        for conn in list(self.subscribers):
+            conn.push(event)
+
+
+    def _listen(self):
+        self.actions.open()
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="appserver-action")
+        self._control_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="appserver-control")
+        try:
+            asyncio.run(self._serve())
+        except OSError as e:
+            self.post_event('error', message=f"Could not bind: {e}")
+        finally:
+            self._executor.shutdown(wait=False)
+            self._control_executor.shutdown(wait=False)
+            self._loop = None
+            self.actions.close()
+            print("appserver: Server stopped")
+            self.post_event('stopped')
+
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        if self.listening != 1:
+            # stop() was called before the loop existed
+            return
+
+        servers = [await asyncio.start_server(
+            self._handle_client, self.host, self.port, reuse_address=True,
+            limit=self.read_size)]
+        print(f"\nappserver: Listening on {(self.host, self.port)} (asyncio)")
+        if self.unix_path:
+            try:
+                usock = self._open_unix_listener()
+            except OSError:
+                servers[0].close()
+                raise
+            servers.append(await asyncio.start_unix_server(
+                self._handle_client, sock=usock, limit=self.read_size))
+            print(f"appserver: Listening on {self.unix_path} (asyncio)")
+        self.post_event('listening', host=self.host, port=self.port,
+            unix_path=self.unix_path)
+
+        try:
+            await self._stop_event.wait()
+        finally:
+            for server in servers:
+                server.close()
+
+            # Hang up on idle clients; busy ones finish their
+            # response first
+            tasks = [conn.task for conn in self.connections]
+            for conn in list(self.connections):
+                if not conn.busy:
+                    conn.writer.close()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+            for server in servers:
+                await server.wait_closed()
+            self._remove_unix_path()
+
+
+    async def _handle_client(self, reader, writer):
+        """ Serve one connection until it closes.
+        """
+        # asyncio has already accepted the socket; time from here
+        # until the connection is set up, as the selectors engine
+        # does after accept()
+        start = time.perf_counter()
+        conn = _Connection(writer)
+        addr = conn.addr
+        print('\n\nappserver: *** Begin Server Event ***')
+        print(f"appserver: Accepted connection from {addr}")
+        if len(self.connections) >= self.max_connections:
+            latency.record("accept", time.perf_counter() - start)
+            await self._reject(conn,
+                f"too many connections (limit {self.max_connections})")
+            await self._close(conn)
+            return
+        self.connections.add(conn)
+        latency.record("accept", time.perf_counter() - start)
+        try:
+            while True:
+                jsonheader = await self._read_header(reader, conn.version)
+                if jsonheader is None:
+                    # Peer hung up between messages
+                    break
+                conn.busy = True
+                keep_alive = (
+                    self.keep_alive and protocol.wants_keep_alive(jsonheader)
+                )
+
+                if jsonheader["content-type"] == protocol.PCM_CONTENT_TYPE:
+                    try:
+                        sink = await self._open_pcm(addr, jsonheader)
+                    except (ValueError, KeyError) as e:
+                        # Bad format, rate, channels or device
+                        await self._reject(
+                            conn, f"cannot play PCM stream: {e}")
+                        break
+                    response = await self._stream_pcm(
+                        sink, jsonheader, reader)
+                else:
+                    content_len = jsonheader["content-length"]
+                    error = self.reserve(content_len)
+                    if error:
+                        await self._reject(conn, error)
+                        break
+                    try:
+                        data = await reader.readexactly(content_len)
+                        response = await self._respond(
+                            conn, jsonheader, data)
+                    finally:
+                        self.release(content_len)
+                conn.send(response, keep_alive=keep_alive)
+                await writer.drain()
+                conn.busy = False
+
+                if not keep_alive or self.listening != 1:
+                    break
+                self._apply_changes(conn)
+        except Exception as e:
+            print(
+                f"appserver: Error: Exception for {addr}:\n"
+                f"{traceback.format_exc()}"
+            )
+            # One client's failure is not a server error; the GUI
+            # only notes it in the status line
+            self.post_event('connection_error', addr=addr,
+                message=str(e).strip())
+        finally:
+            self.connections.discard(conn)
+            self.subscribers.discard(conn)
+            await self._close(conn)
+
+
+    async def _reject(self, conn, reason):
+        """ Answer with an error, without reading the rest of the
+            request. The caller closes the connection.
+        """
+        print(f"appserver: Rejecting {conn.addr}: {reason}")
+        conn.send(protocol.json_response(
+            {"result": f"appserver: Error: {reason}", "error": True}),
+            keep_alive=False)
+        try:
+            await conn.writer.drain()
+        except OSError:
+            pass
+
+
+    async def _close(self, conn):
+        print(f"\nappserver: Closing connection to {conn.addr}")
+        print('appserver: *** End Server Event ***')
+        conn.writer.close()
+        try:
+            await conn.writer.wait_closed()
+        except OSError:
+            pass
+
+
+    def _apply_changes(self, conn):
+        """ Apply a version switch or subscription change once its
+            response has been sent.
+        """
+        if conn.next_version:
+            conn.version = conn.next_version
+            conn.next_version = None
+        if conn.subscription is not None:
+            if conn.subscription:
+                self.subscribers.add(conn)
+            else:
+                self.subscribers.discard(conn)
+            conn.subscription = None
+
+
+    async def _read_header(self, reader, version):
+        """ Read the next message header as a JSON header dict.
+            Returns None if the peer closed between messages.
+        """
+        if version == 2:
+            hdrlen = protocol.V2_HEADER.size
+        else:
+            hdrlen = protocol.PROTOHEADER_LEN
+        try:
+            header = await reader.readexactly(hdrlen)
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise RuntimeError("\nappserver: Peer closed.")
+            return None
+
+        if version == 2:
+            start = time.perf_counter()
+            jsonheader = protocol.v2_jsonheader(header)
+        else:
+            hdrlen = protocol.unpack_protoheader(header)
+            data = await reader.readexactly(hdrlen)
+            start = time.perf_counter()
+            jsonheader = protocol.parse_jsonheader(data)
+        latency.record("header", time.perf_counter() - start)
+        return jsonheader
+
+
+    async def _open_pcm(self, addr, jsonheader):
+        """ Start a PCM upload on the action thread. Returns its
+            PCMSink; raises ValueError for a header it cannot play.
+        """
+        print(f"appserver: Receiving PCM stream from {addr}")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, self.actions.open_pcm_stream, jsonheader)
+
+
+    async def _stream_pcm(self, sink, jsonheader, reader):
+        """ Feed a PCM upload to the player as it arrives and
+            return the create_message() arguments for the response.
+        """
+        loop = asyncio.get_running_loop()
+        remaining = jsonheader["content-length"]
+        while remaining:
+            while sink.full:
+                # Stop reading, so the sender waits for the player
+                await asyncio.sleep(app_server.PCM_POLL_SECONDS)
+            data = await reader.read(min(remaining, self.read_size))
+            if not data:
+                sink.stop()
+                raise RuntimeError("\nappserver: Peer closed.")
+            sink.feed(data)
+            remaining -= len(data)
+        content = await loop.run_in_executor(
+            self._executor, self.actions.close_pcm_stream, sink)
+        return protocol.json_response(content)
+
+
+    async def _respond(self, conn, jsonheader, data):
+        """ Run the request on the action thread and return the
+            create_message() arguments for the response.
+        """
+        addr = conn.addr
+        loop = asyncio.get_running_loop()
+        if jsonheader["content-type"] in (
+            "text/json", protocol.COMPACT_CONTENT_TYPE
+        ):
+            received = (time.monotonic(), time.time())
+            start = time.perf_counter()
+            request = protocol.decode_content(jsonheader, data)
+            latency.record("body", time.perf_counter() - start)
+            print(f"appserver: Received request {request!r} from {addr}")
+            action = protocol.request_action(request)
+            self.post_event('request', addr=addr, action=action)
+            if action in protocol.CONTROL_ACTIONS:
+                executor = self._control_executor
+            else:
+                executor = self._executor
+            content = await loop.run_in_executor(
+                executor, self.actions.handle, request, received)
+            conn.next_version = protocol.negotiated_version(request, content)
+            conn.subscription = protocol.subscription_change(request, content)
+            if conn.version == 2:
+                return protocol.compact_response(content)
+            return protocol.json_response(content)
+        else:
+            # Binary or unknown content-type
+            print(
+                f"appserver: Received {jsonheader['content-type']} "
+                f"request from {addr}"
+            )
+            return self.actions.handle_binary(data)
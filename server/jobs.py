@@ -0,0 +1,141 @@
+""" Background jobs for Socket Audio Player.
+
+    Lets the server answer a request straight away and do the
+    slow part (file loading, device setup) on a worker thread.
+    Clients poll progress with the 'jobstatus' action.
+"""
+
+###########
+# Imports #
+###########
+# Import system packages
+import itertools
+import queue
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+
+#########
+# BEGIN #
+#########
+# Job states, in order
+QUEUED = 'queued'
+LOADING = 'loading'
+PLAYING = 'playing'
+DONE = 'done'
+FAILED = 'failed'
+
+# Lane for long jobs (indexing, preloading), kept apart from
+# the default lane that plays stimuli
+BACKGROUND = 'background'
+
+
+class Job:
+    """ One unit of queued work and its timings.
+    """
+
+    def __init__(self, job_id, action, func, args):
+        self.id = job_id
+        self.action = action
+        self.func = func
+        self.args = args
+        self.state = None
+        self.error = None
+        # Wall-clock time each state was entered
+        self.times = {}
+        # Frames played, once playback has ended
+        self.frames = None
+        # Extra status fields set by the job function
+        self.details = {}
+        self.set_state(QUEUED)
+
+
+    def set_state(self, state):
+        self.state = state
+        self.times[state] = time.time()
+
+
+    def status(self):
+        """ Status dict for the 'jobstatus' action.
+        """
+        status = {
+            "job": self.id,
+            "action": self.action,
+            "state": self.state,
+            "times": dict(self.times),
+        }
+        # Time spent in each stage so far
+        if LOADING in self.times:
+            status["wait_ms"] = \
+                (self.times[LOADING] - self.times[QUEUED]) * 1000
+        if LOADING in self.times and PLAYING in self.times:
+            status["load_ms"] = \
+                (self.times[PLAYING] - self.times[LOADING]) * 1000
+        if self.frames is not None:
+            status["frames"] = self.frames
+        status.update(self.details)
+        if self.error:
+            status["error"] = self.error
+        return status
+
+
+class JobQueue:
+    """ Run jobs on worker threads, keeping the most recent ones
+        for status queries.
+
+        Each lane has its own worker, which runs its jobs one at
+        a time in order; jobs in different lanes run side by side.
+        Job IDs are shared across lanes.
+    """
+
+    def __init__(self, max_jobs=200):
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+        self._ids = itertools.count(1)
+        # Lane name -> queue and worker thread
+        self._queues = {}
+        self._threads = {}
+        self._lock = threading.Lock()
+
+
+    def submit(self, action, func, *args, lane='default'):
+        """ Queue func(job, *args) on a lane and return the new
+            Job.
+        """
+        with self._lock:
+            job = Job(next(self._ids), action, func, args)
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.max_jobs:
+                self.jobs.popitem(last=False)
+            jobs = self._queues.setdefault(lane, queue.Queue())
+            thread = self._threads.get(lane)
+            if thread is None or not thread.is_alive():
+                thread = threading.Thread(target=self._work, args=(jobs,),
+                    name=f"appserver-jobs-{lane}", daemon=True)
+                self._threads[lane] = thread
+                thread.start()
+        jobs.put(job)
+        return job
+
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+
+    def _work(self, jobs):
+        while True:
+            job = jobs.get()
+            try:
+                job.func(job, *job.args)
+            except Exception as e:
+                print(
+                    f"jobs: Error: job {job.id} failed:\n"
+                    f"{traceback.format_exc()}"
+                )
+                job.error = repr(e)
+                job.set_state(FAILED)
+            else:
+                if job.state not in (PLAYING, DONE):
+                    job.set_state(DONE)
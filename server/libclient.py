@@ -0,0 +1,289 @@
+""" Reference client for Socket Audio Player.
+
+    Speaks the same framing as app_server.py: version 1 (JSON
+    header) by default, version 2 after hello(). Used by the
+    benchmarks and as an example for client authors:
+
+        with libclient.Client() as client:
+            client.request("playaudio", {"filepath": path, "level": -20})
+"""
+
+###########
+# Imports #
+###########
+# Import server packages
+import socket
+import statistics
+import struct
+import sys
+import time
+from collections import deque
+
+# Import custom modules
+from server import protocol
+
+
+#########
+# BEGIN #
+#########
+class Client:
+    """ Blocking client holding one connection to the server.
+
+        Events pushed by the server (see subscribe()) can arrive
+        between responses; they are kept in self.events until
+        read with next_event().
+    """
+
+    def __init__(self, host="127.0.0.1", port=65432, unix_path=None,
+        keep_alive=True, timeout=10.0):
+        """ host, port: server TCP address
+            unix_path: connect to this local socket instead
+            keep_alive: reuse the connection for every request;
+                otherwise reconnect for each one
+            timeout: seconds to wait for the server
+        """
+        self.host = host
+        self.port = port
+        self.unix_path = unix_path
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+
+        # Framing version; changed by hello()
+        self.version = 1
+
+        # Events pushed by the server and not yet read
+        self.events = deque()
+
+        self.sock = None
+        self._buffer = bytearray()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def connect(self):
+        if self.unix_path:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.unix_path)
+        else:
+            sock = socket.create_connection(
+                (self.host, self.port), timeout=self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        self.version = 1
+        self._buffer.clear()
+
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+    def request(self, action, value=None):
+        """ Send an action and return the response content dict.
+        """
+        request = {"action": action}
+        if value is not None:
+            request["value"] = value
+        if self.version == 2:
+            message = protocol.create_message_v2(
+                **protocol.compact_request(request),
+                keep_alive=self.keep_alive)
+        else:
+            message = protocol.create_message(
+                **protocol.json_response(request),
+                keep_alive=self.keep_alive)
+        return self._exchange(message)
+
+
+    def send_binary(self, data):
+        """ Send a binary body and return the response body bytes.
+        """
+        args = {
+            "content_bytes": bytes(data),
+            "content_type": "binary/custom-client-binary-type",
+            "content_encoding": "binary",
+        }
+        if self.version == 2:
+            message = protocol.create_message_v2(
+                **args, keep_alive=self.keep_alive)
+        else:
+            message = protocol.create_message(
+                **args, keep_alive=self.keep_alive)
+        return self._exchange(message)
+
+
+    def send_pcm(self, samples, samplerate, channels,
+        sample_format="float32", level=None, prefill=None, device=None):
+        """ Upload interleaved little-endian samples for playback
+            and return the response content dict. Needs a version
+            1 connection.
+        """
+        if self.version != 1:
+            raise RuntimeError("libclient: PCM uploads need protocol v1.")
+        content_bytes = bytes(samples)
+        jsonheader = {
+            "byteorder": sys.byteorder,
+            "content-type": protocol.PCM_CONTENT_TYPE,
+            "content-encoding": "binary",
+            "content-length": len(content_bytes),
+            "connection": "keep-alive" if self.keep_alive else "close",
+            "sample-rate": samplerate,
+            "channels": channels,
+            "sample-format": sample_format,
+        }
+        if level is not None:
+            jsonheader["level"] = level
+        if prefill is not None:
+            jsonheader["prefill"] = prefill
+        if device is not None:
+            jsonheader["device"] = device
+        jsonheader_bytes = protocol.json_encode(jsonheader, "utf-8")
+        message = struct.pack(">H", len(jsonheader_bytes)) \
+            + jsonheader_bytes + content_bytes
+        return self._exchange(message)
+
+
+    def hello(self, versions=protocol.VERSIONS):
+        """ Negotiate a protocol version. Later requests use it.
+        """
+        content = self.request("hello", {"versions": list(versions)})
+        self.version = content.get("version", 1)
+        return content
+
+
+    def ping(self):
+        """ Round-trip time (seconds) of one timesync exchange.
+        """
+        start = time.perf_counter()
+        self.request("timesync")
+        return time.perf_counter() - start
+
+
+    def timesync(self, exchanges=8, clock="wall"):
+        """ Estimate the offset of the server's clock from this
+            one over several timesync exchanges (see
+            estimate_offset()).
+
+            clock: "wall" (time.time()) or "monotonic"
+                (time.monotonic(); only comparable between
+                processes on the same machine)
+        """
+        now = time.time if clock == "wall" else time.monotonic
+        field = "wall" if clock == "wall" else "mono"
+        samples = []
+        for _ in range(exchanges):
+            t0 = now()
+            content = self.request("timesync", {"client": t0})
+            t3 = now()
+            samples.append((t0, content[f"recv_{field}"],
+                content[f"send_{field}"], t3))
+        return estimate_offset(samples)
+
+
+    def subscribe(self):
+        return self.request("subscribe")
+
+
+    def next_event(self):
+        """ Return the next pushed event, waiting for one if none
+            has arrived yet.
+        """
+        if not self.events:
+            self.events.append(self._recv()[1])
+        return self.events.popleft()
+
+
+    def _exchange(self, message):
+        if self.sock is None:
+            self.connect()
+        try:
+            self.sock.sendall(message)
+            while True:
+                jsonheader, content = self._recv()
+                if protocol.is_event(content):
+                    self.events.append(content)
+                else:
+                    break
+        except BaseException:
+            self.close()
+            raise
+        if not protocol.wants_keep_alive(jsonheader):
+            self.close()
+        return content
+
+
+    def _fill(self, n):
+        while len(self._buffer) < n:
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError("libclient: Server closed connection.")
+            self._buffer += data
+
+
+    def _take(self, n):
+        self._fill(n)
+        data = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        return data
+
+
+    def _recv(self):
+        """ Read one message. Returns (jsonheader, content), with
+            JSON and compact bodies decoded to dicts.
+        """
+        if self.version == 2:
+            jsonheader = protocol.v2_jsonheader(
+                self._take(protocol.V2_HEADER.size))
+        else:
+            hdrlen = protocol.unpack_protoheader(
+                self._take(protocol.PROTOHEADER_LEN))
+            jsonheader = protocol.parse_jsonheader(self._take(hdrlen))
+        data = self._take(jsonheader["content-length"])
+        if jsonheader["content-type"] in (
+            "text/json", protocol.COMPACT_CONTENT_TYPE
+        ):
+            return jsonheader, protocol.decode_content(
+                jsonheader, data, response=True)
+        return jsonheader, data
+
+
+def estimate_offset(samples):
+    """ NTP-style clock offset estimate.
+
+        samples: (t0, t1, t2, t3) tuples: client send, server
+            receive, server send and client receive times
+
+        Each exchange gives offset ((t1 - t0) + (t2 - t3)) / 2 and
+        round-trip time (t3 - t0) - (t2 - t1). The exchange with
+        the shortest round trip is taken as the estimate, since it
+        suffered least from queueing. Jitter is the RMS difference
+        of the other offsets from it. Returns a dict in ms; add
+        offset_ms to a client time to get server time.
+    """
+    exchanges = []
+    for t0, t1, t2, t3 in samples:
+        offset = ((t1 - t0) + (t2 - t3)) / 2
+        rtt = (t3 - t0) - (t2 - t1)
+        exchanges.append((rtt, offset))
+    exchanges.sort()
+    best_rtt, best_offset = exchanges[0]
+    rtts = [rtt for rtt, _ in exchanges]
+    jitter = (
+        sum((offset - best_offset) ** 2 for _, offset in exchanges)
+        / len(exchanges)
+    ) ** 0.5
+    return {
+        "offset_ms": best_offset * 1000,
+        "rtt_ms": best_rtt * 1000,
+        "rtt_median_ms": statistics.median(rtts) * 1000,
+        "jitter_ms": jitter * 1000,
+        "exchanges": len(exchanges),
+    }
@@ -7,30 +7,144 @@
 # Imports #
 ###########
 # Import server packages
-import sys
 import selectors
-import json
-import io
-import struct
+from collections import deque
 
-# Import GUI packages
-from tkinter import messagebox
+# Import system packages
+import time
 
 # Import custom modules
-from models import audiomodel
-import sounddevice as sd
+from models import latency
+from server import protocol
+
+
+#########
+# BEGIN #
+#########
+# Default number of bytes asked of each recv
+READ_SIZE = 65536
+
+# Most bytes of a large request body read per event
+BODY_READ_SIZE = 2**20
+
+
+class ReceiveBuffer:
+    """ Preallocated receive buffer filled with recv_into().
+
+        Data is appended at the end and consumed from the front
+        without re-slicing. Unread bytes are only moved when
+        the free space at the end runs out.
+    """
+
+    def __init__(self, size=READ_SIZE):
+        self._buf = bytearray(size)
+        self._start = 0
+        self._end = 0
+
+
+    def __len__(self):
+        return self._end - self._start
+
+
+    def recv_into(self, sock, nbytes):
+        """ Receive up to nbytes from sock. Returns the number of
+            bytes received (0 when the peer has closed).
+        """
+        self._reserve(nbytes)
+        with memoryview(self._buf) as view:
+            received = sock.recv_into(
+                view[self._end:self._end + nbytes], nbytes)
+        self._end += received
+        return received
+
+
+    def _reserve(self, nbytes):
+        """ Make room for nbytes after the unread data.
+        """
+        if len(self._buf) - self._end >= nbytes:
+            return
+        used = len(self)
+        if len(self._buf) - used >= nbytes:
+            # Enough room once unread data is moved to the front
+            self._buf[:used] = self._buf[self._start:self._end]
+        else:
+            grown = bytearray(max(2 * len(self._buf), used + nbytes))
+            grown[:used] = self._buf[self._start:self._end]
+            self._buf = grown
+        self._start = 0
+        self._end = used
+
+
+    def unpack_protoheader(self):
+        """ Read the fixed header in place.
+        """
+        return protocol.unpack_protoheader(self._buf, self._start)
+
+
+    def consume(self, nbytes):
+        """ Remove and return the next nbytes as bytes.
+        """
+        data = bytes(self._buf[self._start:self._start + nbytes])
+        self.skip(nbytes)
+        return data
+
+
+    def consume_into(self, target):
+        """ Move as much unread data as fits into target (a
+            writable buffer). Returns the number of bytes moved.
+        """
+        nbytes = min(len(self), len(target))
+        target[:nbytes] = self._buf[self._start:self._start + nbytes]
+        self.skip(nbytes)
+        return nbytes
+
+
+    def skip(self, nbytes):
+        """ Discard the next nbytes.
+        """
+        self._start += nbytes
+        if self._start == self._end:
+            # Empty: start filling from the front again
+            self._start = self._end = 0
+
 
 class Message:
     def __init__(self, server, selector, sock, addr, audio_device):
         self.selector = selector
         self.sock = sock
         self.addr = addr
-        self._recv_buffer = b""
-        self._send_buffer = b""
+        self.read_size = server.read_size
+        self._recv_buffer = ReceiveBuffer(self.read_size)
+        # Outgoing data as a queue of memoryviews; sent without
+        # re-slicing the underlying bytes
+        self._send_buffer = deque()
+        # Large request bodies are received straight into place
+        self._body = None
+        self._body_filled = 0
+        # Bytes reserved against the server's buffer limits
+        self._reserved = 0
+        # PCM uploads are fed to a player as they arrive
+        self._pcm = None
+        self._pcm_remaining = 0
+        # (time.monotonic(), time.time()) when the request body
+        # was read
+        self._received = None
+        # Unregistered while the player's buffer is full, and the
+        # events to listen for once it has room
+        self._paused = False
+        self._paused_events = None
         self._jsonheader_len = None
         self.jsonheader = None
         self.request = None
         self.response_created = False
+        self.keep_alive = False
+
+        # Framing version; changed by a 'hello' request
+        self.version = 1
+        self._next_version = None
+
+        # Subscribe/unsubscribe to apply after the response
+        self._subscription = None
 
         #self.event_to_send = None
         self.server = server
@@ -38,37 +152,14 @@ class Message:
 
 
     def _create_response_json_content(self):
-        action = self.request.get("action")
-        if action == "playaudio":
-            self.audio_dict = self.request.get("value")
-            answer = f"\nFound file: {self.audio_dict.get('filepath')}\n" \
-                f"Found level: {self.audio_dict.get('level')}"
-            content = {"result": answer}
-            #self.event_to_send = '<<ServerPlayAudio>>'
-            #print(f"libserver: File = {self.audio_dict.get('filepath')}")
-            self.a = audiomodel.Audio(
-                file_path=self.audio_dict.get('filepath'))
-            self.a.play(
-                level=self.audio_dict.get('level'),
-                device_id=self.audio_device)
-        elif action == "stopaudio":
-            content = {"result": "Stopping audio playback"}
-            #self.event_to_send = "<<ServerStopAudio>>"
-            sd.stop()
-        elif action == "killserver":
-            content = {"result": "Killing server"}
-            #self.selector.close()
-            self.server.listening = 0
-            print("libserver: Server killed!")
-        else:
-            content = {"result": f"libserver: Error: invalid action '{action}'."}
-        content_encoding = "utf-8"
-        response = {
-            "content_bytes": self._json_encode(content, content_encoding),
-            "content_type": "text/json",
-            "content_encoding": content_encoding,
-        }
-        return response
+        content = self.server.actions.handle(self.request, self._received)
+        self._next_version = protocol.negotiated_version(
+            self.request, content)
+        self._subscription = protocol.subscription_change(
+            self.request, content)
+        if self.version == 2:
+            return protocol.compact_response(content)
+        return protocol.json_response(content)
 
 
     def _set_selector_events_mask(self, mode):
@@ -82,75 +173,181 @@ class Message:
             events = selectors.EVENT_READ | selectors.EVENT_WRITE
         else:
             raise ValueError(f"\nlibserver: Invalid events mask mode {mode!r}.")
+        if self._paused:
+            # Applied when reading resumes
+            self._paused_events = events
+            return
         self.selector.modify(self.sock, events, data=self)
 
 
+    def _reset(self):
+        """ Clear per-message state so a keep-alive connection
+            can carry the next request.
+        """
+        self._jsonheader_len = None
+        self.jsonheader = None
+        self.request = None
+        self.response_created = False
+        self._body = None
+        self._body_filled = 0
+        self._pcm = None
+        self._pcm_remaining = 0
+        self._received = None
+        self._release()
+
+
+    def _release(self):
+        if self._reserved:
+            self.server.release(self._reserved)
+            self._reserved = 0
+
+
+    def has_request(self):
+        """ True when a request is waiting for its response.
+        """
+        return self.request is not None and not self.response_created
+
+
+    def is_control(self):
+        """ True if the pending request is a control action.
+        """
+        return (
+            isinstance(self.request, dict)
+            and self.request.get("action") in protocol.CONTROL_ACTIONS
+        )
+
+
+    def reject(self, reason):
+        """ Answer with an error and close, without reading the
+            rest of the request.
+        """
+        print(f"libserver: Rejecting {self.addr}: {reason}")
+        self.keep_alive = False
+        self.request = {}
+        self.response_created = True
+        message = self._create_message(**protocol.json_response(
+            {"result": f"libserver: Error: {reason}", "error": True}))
+        self._send_buffer.append(memoryview(message))
+        self._set_selector_events_mask("w")
+
+
+    def _is_idle(self):
+        """ True when no partial message is waiting in the buffer.
+        """
+        return self._jsonheader_len is None and not len(self._recv_buffer)
+
+
     def _read(self):
+        """ Read available bytes into the receive buffer (or the
+            request body). Returns False if the connection was
+            closed.
+        """
         try:
             # Should be ready to read
-            data = self.sock.recv(4096)
+            if self._body is not None:
+                received = self._recv_body()
+            else:
+                received = self._recv_buffer.recv_into(
+                    self.sock, self.read_size)
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
             pass
         else:
-            if data:
-                self._recv_buffer += data
-            else:
+            if not received:
+                if self.keep_alive and self._is_idle():
+                    # Keep-alive peer hung up between messages
+                    self.close()
+                    return False
                 raise RuntimeError("\nlibserver: Peer closed.")
+        return True
+
+
+    def _recv_body(self):
+        """ Receive the rest of a large request body directly into
+            its own preallocated buffer.
+        """
+        # Bounded so one large upload cannot hog the loop
+        end = self._body_filled + BODY_READ_SIZE
+        with memoryview(self._body) as view:
+            received = self.sock.recv_into(view[self._body_filled:end])
+        self._body_filled += received
+        return received
 
 
     def _write(self):
         if self._send_buffer:
-            print(f"\nlibserver: Sending {self._send_buffer!r} to {self.addr}")
             try:
                 # Should be ready to write
-                sent = self.sock.send(self._send_buffer)
+                sent = self.sock.send(self._send_buffer[0])
             except BlockingIOError:
                 # Resource temporarily unavailable (errno EWOULDBLOCK)
                 pass
             else:
-                self._send_buffer = self._send_buffer[sent:]
-                # Close when the buffer is drained. The response has been sent.
+                print(f"\nlibserver: Sent {sent} bytes to {self.addr}")
+                if sent == len(self._send_buffer[0]):
+                    self._send_buffer.popleft()
+                else:
+                    self._send_buffer[0] = self._send_buffer[0][sent:]
+                # The response has been sent once the buffer is drained.
+                # Keep-alive connections wait for the next request;
+                # everything else is closed.
                 if sent and not self._send_buffer:
-                    self.close()
-
-
-    def _json_encode(self, obj, encoding):
-        return json.dumps(obj, ensure_ascii=False).encode(encoding)
+                    if not self.response_created:
+                        # Only pushed events were sent
+                        self._set_selector_events_mask("r")
+                    elif self.keep_alive:
+                        if self._next_version:
+                            self.version = self._next_version
+                            self._next_version = None
+                        if self._subscription is not None:
+                            self._apply_subscription()
+                        self._reset()
+                        self._set_selector_events_mask("r")
+                        # Pipelined requests may already be buffered
+                        self._process_buffer()
+                    else:
+                        self.close()
+
+
+    def _apply_subscription(self):
+        if self._subscription:
+            self.server.subscribers.add(self)
+        else:
+            self.server.subscribers.discard(self)
+        self._subscription = None
 
 
-    def _json_decode(self, json_bytes, encoding):
-        tiow = io.TextIOWrapper(
-            io.BytesIO(json_bytes), encoding=encoding, newline=""
-        )
-        obj = json.load(tiow)
-        tiow.close()
-        return obj
+    def push(self, event):
+        """ Queue an event message for a subscribed connection.
+        """
+        if self.sock is None:
+            return
+        message = self._create_message(**protocol.json_response(event))
+        self._send_buffer.append(memoryview(message))
+        if self.request is None:
+            # Keep reading the next request while the event is sent
+            self._set_selector_events_mask("rw")
 
 
     def _create_message(
         self, *, content_bytes, content_type, content_encoding
     ):
-        jsonheader = {
-            "byteorder": sys.byteorder,
-            "content-type": content_type,
-            "content-encoding": content_encoding,
-            "content-length": len(content_bytes),
-        }
-        jsonheader_bytes = self._json_encode(jsonheader, "utf-8")
-        message_hdr = struct.pack(">H", len(jsonheader_bytes))
-        message = message_hdr + jsonheader_bytes + content_bytes
-        return message
+        if self.version == 2:
+            return protocol.create_message_v2(
+                content_bytes=content_bytes,
+                content_type=content_type,
+                keep_alive=self.keep_alive,
+            )
+        return protocol.create_message(
+            content_bytes=content_bytes,
+            content_type=content_type,
+            content_encoding=content_encoding,
+            keep_alive=self.keep_alive,
+        )
 
 
     def _create_response_binary_content(self):
-        response = {
-            "content_bytes": b"First 10 bytes of request: "
-            + self.request[:10],
-            "content_type": "binary/custom-server-binary-type",
-            "content_encoding": "binary",
-        }
-        return response
+        return self.server.actions.handle_binary(self.request)
 
 
     def process_events(self, mask):
@@ -161,8 +358,13 @@ class Message:
 
 
     def read(self):
-        self._read()
+        if self._read():
+            self._process_buffer()
 
+
+    def _process_buffer(self):
+        """ Parse as much of the next message as is buffered.
+        """
         if self._jsonheader_len is None:
             self.process_protoheader()
 
@@ -176,7 +378,7 @@ class Message:
 
 
     def write(self):
-        if self.request:
+        if self.request is not None:
             if not self.response_created:
                 self.create_response()
 
@@ -186,8 +388,17 @@ class Message:
     def close(self):
         print(f"\nlibserver: Closing connection to {self.addr}")
         print('libserver: *** End Server Event ***')
+        self.server.subscribers.discard(self)
+        self.server.connections.discard(self)
+        self.server.paused.discard(self)
+        self._release()
+        if self._pcm is not None:
+            # Upload cut short: do not keep playing silence
+            self._pcm.stop()
+            self._pcm = None
         try:
-            self.selector.unregister(self.sock)
+            if not self._paused:
+                self.selector.unregister(self.sock)
         except Exception as e:
             print(
                 f"libserver: Error: selector.unregister() exception for "
@@ -204,41 +415,133 @@ class Message:
 
 
     def process_protoheader(self):
-        hdrlen = 2
+        if self.version == 2:
+            self._process_v2_header()
+            return
+        hdrlen = protocol.PROTOHEADER_LEN
         if len(self._recv_buffer) >= hdrlen:
-            self._jsonheader_len = struct.unpack(
-                ">H", self._recv_buffer[:hdrlen]
-            )[0]
-            self._recv_buffer = self._recv_buffer[hdrlen:]
+            self._jsonheader_len = self._recv_buffer.unpack_protoheader()
+            self._recv_buffer.skip(hdrlen)
+
+
+    def _process_v2_header(self):
+        """ Parse a v2 fixed header into an equivalent JSON header.
+        """
+        hdrlen = protocol.V2_HEADER.size
+        if len(self._recv_buffer) >= hdrlen:
+            self._jsonheader_len = hdrlen
+            start = time.perf_counter()
+            self.jsonheader = protocol.v2_jsonheader(
+                self._recv_buffer.consume(hdrlen))
+            latency.record("header", time.perf_counter() - start)
+            self._on_jsonheader()
 
 
     def process_jsonheader(self):
         hdrlen = self._jsonheader_len
         if len(self._recv_buffer) >= hdrlen:
-            self.jsonheader = self._json_decode(
-                self._recv_buffer[:hdrlen], "utf-8"
+            start = time.perf_counter()
+            self.jsonheader = protocol.parse_jsonheader(
+                self._recv_buffer.consume(hdrlen)
             )
-            self._recv_buffer = self._recv_buffer[hdrlen:]
-            for reqhdr in (
-                "byteorder",
-                "content-length",
-                "content-type",
-                "content-encoding",
-            ):
-                if reqhdr not in self.jsonheader:
-                    raise ValueError(f"libserver: Missing required header '{reqhdr}'.")
+            latency.record("header", time.perf_counter() - start)
+            self._on_jsonheader()
+
+
+    def _on_jsonheader(self):
+        """ Act on a newly parsed header.
+        """
+        # Optional header: keep the connection open for more requests
+        self.keep_alive = (
+            self.server.keep_alive
+            and protocol.wants_keep_alive(self.jsonheader)
+        )
+        if self.jsonheader["content-type"] == protocol.PCM_CONTENT_TYPE:
+            # Played as it arrives, and held back by the player's
+            # own buffer limit rather than the server's
+            print(f"libserver: Receiving PCM stream from {self.addr}")
+            try:
+                self._pcm = self.server.actions.open_pcm_stream(
+                    self.jsonheader)
+            except (ValueError, KeyError) as e:
+                # Bad format, rate, channels or device
+                self.reject(f"cannot play PCM stream: {e}")
+                return
+            self._pcm_remaining = self.jsonheader["content-length"]
+            return
+        content_len = self.jsonheader["content-length"]
+        error = self.server.reserve(content_len)
+        if error:
+            self.reject(error)
+        else:
+            self._reserved = content_len
+
+
+    def _feed_pcm(self):
+        """ Pass buffered PCM to the player as it arrives. Once
+            the whole body is in, the request holds the response
+            content.
+        """
+        nbytes = min(len(self._recv_buffer), self._pcm_remaining)
+        if nbytes:
+            self._pcm.feed(self._recv_buffer.consume(nbytes))
+            self._pcm_remaining -= nbytes
+        if not self._pcm_remaining:
+            self.request = self.server.actions.close_pcm_stream(self._pcm)
+            self._pcm = None
+            self._set_selector_events_mask("w")
+        elif self._pcm.full:
+            # Stop reading, so the sender waits for the player
+            self._paused_events = self.selector.get_key(self.sock).events
+            self.selector.unregister(self.sock)
+            self._paused = True
+            self.server.paused.add(self)
+
+
+    def resume_pcm(self):
+        """ Start reading a paused PCM upload again once the
+            player's buffer has room. Called by the server.
+        """
+        if self._pcm is not None and self._pcm.full:
+            return
+        self._paused = False
+        self.server.paused.discard(self)
+        self.selector.register(self.sock, self._paused_events, data=self)
 
 
     def process_request(self):
+        if self._pcm is not None:
+            self._feed_pcm()
+            return
         content_len = self.jsonheader["content-length"]
-        if not len(self._recv_buffer) >= content_len:
+        if self._body is None:
+            if len(self._recv_buffer) >= content_len:
+                data = self._recv_buffer.consume(content_len)
+            else:
+                # Receive the rest straight into a buffer of the
+                # final size rather than growing the receive buffer
+                self._body = bytearray(content_len)
+                self._body_filled = self._recv_buffer.consume_into(self._body)
+                return
+        elif self._body_filled < content_len:
             return
-        data = self._recv_buffer[:content_len]
-        self._recv_buffer = self._recv_buffer[content_len:]
-        if self.jsonheader["content-type"] == "text/json":
-            encoding = self.jsonheader["content-encoding"]
-            self.request = self._json_decode(data, encoding)
+        else:
+            data = self._body
+            self._body = None
+        if self.jsonheader["content-type"] in (
+            "text/json", protocol.COMPACT_CONTENT_TYPE
+        ):
+            self._received = (time.monotonic(), time.time())
+            start = time.perf_counter()
+            self.request = protocol.decode_content(self.jsonheader, data)
+            if self.request is None:
+                # A 'null' body; None would read as no request, so
+                # keep another non-object for handle() to refuse
+                self.request = ()
+            latency.record("body", time.perf_counter() - start)
             print(f"libserver: Received request {self.request!r} from {self.addr}")
+            self.server.post_event('request', addr=self.addr,
+                action=protocol.request_action(self.request))
         else:
             # Binary or unknown content-type
             self.request = data
@@ -251,11 +554,15 @@ class Message:
 
 
     def create_response(self):
-        if self.jsonheader["content-type"] == "text/json":
+        if self.jsonheader["content-type"] in (
+            "text/json", protocol.COMPACT_CONTENT_TYPE
+        ):
             response = self._create_response_json_content()
+        elif self.jsonheader["content-type"] == protocol.PCM_CONTENT_TYPE:
+            response = protocol.json_response(self.request)
         else:
             # Binary or unknown content-type
             response = self._create_response_binary_content()
         message = self._create_message(**response)
         self.response_created = True
-        self._send_buffer += message
+        self._send_buffer.append(memoryview(message))
@@ -0,0 +1,317 @@
+""" Message framing for Socket Audio Player.
+
+    Version 1: every message is a 2-byte big-endian length, a
+    JSON header of that length, then the content.
+
+    Version 2: an 8-byte struct-packed header (version, content
+    code, flags, content length), then the content. Hot actions
+    use a compact binary body instead of JSON. A connection
+    starts in version 1 and switches after a 'hello' request
+    negotiates version 2.
+
+    Shared by the server engines (and any client) so they all
+    speak the same format.
+"""
+
+###########
+# Imports #
+###########
+# Import system packages
+import sys
+import json
+import math
+import struct
+
+
+#########
+# BEGIN #
+#########
+# Length of the fixed protocol header
+PROTOHEADER_LEN = 2
+
+# Raw audio upload; played while it is being received
+PCM_CONTENT_TYPE = "audio/pcm"
+
+# Extra headers a PCM upload must carry
+PCM_HEADERS = ("sample-rate", "channels")
+
+# Device used when a request names none
+DEFAULT_DEVICE = "default"
+
+# Actions serviced ahead of others
+CONTROL_ACTIONS = ("stopaudio", "killserver")
+
+# Headers every message must carry
+REQUIRED_HEADERS = (
+    "byteorder",
+    "content-length",
+    "content-type",
+    "content-encoding",
+)
+
+
+def json_encode(obj, encoding):
+    return json.dumps(obj, ensure_ascii=False).encode(encoding)
+
+
+def json_decode(json_bytes, encoding):
+    # Decodes straight from bytes, bytearray or memoryview
+    return json.loads(str(json_bytes, encoding))
+
+
+def unpack_protoheader(data, offset=0):
+    """ Return the JSON header length from the fixed header
+        starting at offset. Works on any buffer without copying.
+    """
+    return struct.unpack_from(">H", data, offset)[0]
+
+
+def parse_jsonheader(data):
+    """ Decode a JSON header and check the required fields.
+    """
+    jsonheader = json_decode(data, "utf-8")
+    for reqhdr in REQUIRED_HEADERS:
+        if reqhdr not in jsonheader:
+            raise ValueError(f"protocol: Missing required header '{reqhdr}'.")
+    return jsonheader
+
+
+def wants_keep_alive(jsonheader):
+    """ True if the sender asked to keep the connection open.
+    """
+    return jsonheader.get("connection") == "keep-alive"
+
+
+def create_message(
+    *, content_bytes, content_type, content_encoding, keep_alive=False
+):
+    """ Frame content for sending.
+    """
+    jsonheader = {
+        "byteorder": sys.byteorder,
+        "content-type": content_type,
+        "content-encoding": content_encoding,
+        "content-length": len(content_bytes),
+        "connection": "keep-alive" if keep_alive else "close",
+    }
+    jsonheader_bytes = json_encode(jsonheader, "utf-8")
+    message_hdr = struct.pack(">H", len(jsonheader_bytes))
+    message = message_hdr + jsonheader_bytes + content_bytes
+    return message
+
+
+def json_response(content, encoding="utf-8"):
+    """ Keyword arguments for create_message() carrying JSON.
+    """
+    return {
+        "content_bytes": json_encode(content, encoding),
+        "content_type": "text/json",
+        "content_encoding": encoding,
+    }
+
+
+#############
+# Version 2 #
+#############
+# Protocol versions this server speaks, oldest first
+VERSIONS = (1, 2)
+
+# version, content code, flags, pad, content length
+V2_HEADER = struct.Struct(">BBBxI")
+
+# Content codes
+V2_CONTENT_JSON = 0
+V2_CONTENT_COMPACT = 1
+V2_CONTENT_BINARY = 2
+
+# Flags
+V2_FLAG_CLOSE = 0x01
+
+# Content type used for compact bodies in header dicts
+COMPACT_CONTENT_TYPE = "application/x-compact"
+
+# Content types for each v2 content code
+V2_CONTENT_TYPES = {
+    V2_CONTENT_JSON: "text/json",
+    V2_CONTENT_COMPACT: COMPACT_CONTENT_TYPE,
+    V2_CONTENT_BINARY: "binary/custom-server-binary-type",
+}
+
+# Actions with a compact request body, and their codes
+COMPACT_ACTIONS = {
+    'playaudio': 1,
+    'stopaudio': 2,
+}
+_COMPACT_NAMES = {code: name for name, code in COMPACT_ACTIONS.items()}
+
+# Value fields each compact action carries; requests with any
+# other field are sent as JSON
+_COMPACT_FIELDS = {
+    'playaudio': {'filepath', 'level'},
+    'stopaudio': set(),
+}
+
+# Compact playaudio: action code and level (NaN for none), then
+# the UTF-8 file path
+_COMPACT_PLAY = struct.Struct(">Bd")
+_COMPACT_CODE = struct.Struct(">B")
+
+
+def negotiate(offered):
+    """ Highest protocol version both sides speak.
+    """
+    common = set(VERSIONS).intersection(offered or (1,))
+    return max(common) if common else 1
+
+
+def request_action(request):
+    """ Action name of a decoded request, or None if the request
+        is not a JSON object.
+    """
+    if isinstance(request, dict):
+        return request.get("action")
+    return None
+
+
+def negotiated_version(request, content):
+    """ Version agreed by a 'hello' request, or None if the
+        request was not a hello.
+    """
+    if isinstance(request, dict) and request.get("action") == "hello":
+        return content.get("version")
+    return None
+
+
+def subscription_change(request, content):
+    """ True/False if the request was a subscribe/unsubscribe,
+        otherwise None.
+    """
+    if isinstance(request, dict) and request.get("action") in (
+        "subscribe", "unsubscribe"
+    ):
+        return content.get("subscribed")
+    return None
+
+
+def is_event(content):
+    """ True for messages pushed by the server rather than sent
+        in response to a request.
+    """
+    return isinstance(content, dict) and "event" in content
+
+
+def v2_jsonheader(data, offset=0):
+    """ Unpack a v2 fixed header into the same dict a v1 JSON
+        header would give, so the rest of the code can treat both
+        versions alike.
+    """
+    version, code, flags, length = V2_HEADER.unpack_from(data, offset)
+    if version != 2:
+        raise ValueError(f"protocol: Unexpected version {version} frame.")
+    try:
+        content_type = V2_CONTENT_TYPES[code]
+    except KeyError:
+        raise ValueError(f"protocol: Unknown v2 content code {code}.")
+    return {
+        "byteorder": "big",
+        "content-type": content_type,
+        "content-encoding": "binary" if code else "utf-8",
+        "content-length": length,
+        "connection": "close" if flags & V2_FLAG_CLOSE else "keep-alive",
+    }
+
+
+def create_message_v2(
+    *, content_bytes, content_type, content_encoding=None, keep_alive=True
+):
+    """ Frame content with the v2 fixed header.
+    """
+    if content_type == "text/json":
+        code = V2_CONTENT_JSON
+    elif content_type == COMPACT_CONTENT_TYPE:
+        code = V2_CONTENT_COMPACT
+    else:
+        code = V2_CONTENT_BINARY
+    flags = 0 if keep_alive else V2_FLAG_CLOSE
+    return V2_HEADER.pack(2, code, flags, len(content_bytes)) + content_bytes
+
+
+def encode_compact_request(request):
+    """ Compact body for a request, or None if the action has no
+        compact form or the request has fields it cannot carry.
+    """
+    action = request.get("action")
+    code = COMPACT_ACTIONS.get(action)
+    if code is None or not set(request) <= {"action", "value"}:
+        return None
+    value = request.get("value") or {}
+    if not isinstance(value, dict) \
+        or not set(value) <= _COMPACT_FIELDS[action]:
+        return None
+    if action == 'playaudio':
+        level = value.get("level")
+        return _COMPACT_PLAY.pack(
+            code, math.nan if level is None else level) \
+            + str(value.get("filepath", "")).encode("utf-8")
+    return _COMPACT_CODE.pack(code)
+
+
+def decode_compact_request(data):
+    """ Request dict from a compact body.
+    """
+    code = data[0]
+    try:
+        action = _COMPACT_NAMES[code]
+    except KeyError:
+        raise ValueError(f"protocol: Unknown compact action code {code}.")
+    if action == 'playaudio':
+        _, level = _COMPACT_PLAY.unpack_from(data)
+        return {
+            "action": action,
+            "value": {
+                "filepath": str(data[_COMPACT_PLAY.size:], "utf-8"),
+                "level": None if math.isnan(level) else level,
+            },
+        }
+    return {"action": action}
+
+
+def compact_response(content):
+    """ create_message_v2() arguments for response content.
+        Content holding only a result message is sent as UTF-8
+        text; anything else is sent as JSON.
+    """
+    if set(content) == {"result"}:
+        return {
+            "content_bytes": str(content["result"]).encode("utf-8"),
+            "content_type": COMPACT_CONTENT_TYPE,
+            "content_encoding": "binary",
+        }
+    return json_response(content)
+
+
+def compact_request(request):
+    """ create_message_v2() arguments for a request, compact when
+        the action allows it.
+    """
+    content_bytes = encode_compact_request(request)
+    if content_bytes is None:
+        return json_response(request)
+    return {
+        "content_bytes": content_bytes,
+        "content_type": COMPACT_CONTENT_TYPE,
+        "content_encoding": "binary",
+    }
+
+
+def decode_content(jsonheader, data, response=False):
+    """ Decode a JSON or compact body into a dict.
+    """
+    content_type = jsonheader["content-type"]
+    if content_type == "text/json":
+        return json_decode(data, jsonheader["content-encoding"])
+    if content_type == COMPACT_CONTENT_TYPE:
+        if response:
+            return {"result": str(data, "utf-8")}
+        return decode_compact_request(data)
+    raise ValueError(f"protocol: Cannot decode content type {content_type}.")
@@ -55,6 +55,15 @@ class AudioDialog(tk.Toplevel):
             textvariable=self.sessionpars['Audio Device ID'], width=6)
         ent_deviceID.grid(column=10, row=10, sticky='w', **options_small)
 
+        # Further devices, selected by name in requests
+        ttk.Label(lblfrm_settings, text="Named Devices:").grid(
+            column=5, row=15, sticky='e', **options_small)
+        ent_named = ttk.Entry(lblfrm_settings,
+            textvariable=self.sessionpars['Named Devices'], width=24)
+        ent_named.grid(column=10, row=15, sticky='w', **options_small)
+        ttk.Label(lblfrm_settings, text="e.g. phones=5, array=3").grid(
+            column=10, row=20, sticky='w', **options_small)
+
         # Submit button
         btnDeviceID = ttk.Button(self, text="Submit", 
             command=self._on_submit)
@@ -5,6 +5,7 @@
 # Imports #
 ###########
 # Import GUI packages
+import tkinter as tk
 from tkinter import ttk
 
 
@@ -15,6 +16,9 @@ class MainFrame(ttk.Frame):
     def __init__(self, parent, *args, **kwargs):
         super().__init__(parent, *args, **kwargs)
 
+        # Server status text
+        self.status = tk.StringVar(value="Server not running")
+
         # Populate frame with widgets
         self.draw_widgets()
 
@@ -53,3 +57,15 @@ class MainFrame(ttk.Frame):
         ttk.Label(lfrm_note, text="This window must remain open for audio playback!", 
                   style='TLabel'
                   ).grid(row=5, column=5, **options)
+
+        lfrm_status = ttk.LabelFrame(frm_main, text="Server Status:")
+        lfrm_status.grid(row=15, column=5, pady=10, sticky='we')
+
+        ttk.Label(lfrm_status, textvariable=self.status, style='TLabel'
+                  ).grid(row=5, column=5, **options)
+
+
+    def set_status(self, text):
+        """ Display the latest server status
+        """
+        self.status.set(text)